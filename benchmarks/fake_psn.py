@@ -0,0 +1,228 @@
+"""Local stand-in for the PSN endpoints used by the plugin.
+
+Every upstream host is served under a path prefix, e.g. https://pl-tpy.np.community.playstation.net/trophy/...
+becomes http://127.0.0.1:<port>/pl-tpy.np.community.playstation.net/trophy/... (see rewrite_url).
+"""
+import asyncio
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+from aiohttp import web
+
+BASE_TIME = 1500000000
+
+
+@dataclass
+class LatencyProfile:
+    base: float = 0.0  # seconds
+    jitter: float = 0.0
+    error_rate: float = 0.0  # share of requests answered with 503
+    throttle_rate: float = 0.0  # share of requests answered with 429
+    timeout_rate: float = 0.0  # share of requests that hang for `hang` seconds
+    hang: float = 60.0
+
+
+LATENCY_PROFILES = {
+    "none": LatencyProfile(),
+    "lan": LatencyProfile(base=0.002, jitter=0.002),
+    "typical": LatencyProfile(base=0.05, jitter=0.03),
+    "slow": LatencyProfile(base=0.2, jitter=0.15),
+    "flaky": LatencyProfile(base=0.05, jitter=0.05, error_rate=0.02, throttle_rate=0.02, timeout_rate=0.005, hang=5),
+}
+
+
+@dataclass
+class Account:
+    titles: int = 500
+    trophies: int = 5000
+    friends: int = 200
+    seed: int = 0
+    games: List[Dict] = field(default_factory=list)
+    trophy_titles: List[Dict] = field(default_factory=list)
+    trophies_by_title: Dict[str, List[Dict]] = field(default_factory=dict)
+    profiles: List[Dict] = field(default_factory=list)
+
+    def generate(self):
+        rng = random.Random(self.seed)
+        with_trophies = max(1, int(self.titles * 0.8))
+        per_title = max(1, self.trophies // with_trophies)
+        for index in range(self.titles):
+            title_id = "CUSA{:05d}_00".format(index)
+            comm_id = "NPWR{:05d}_00".format(index) if index < with_trophies else None
+            self.games.append({"titleId": title_id, "name": "Game {}".format(index), "commId": comm_id})
+            if comm_id is None:
+                continue
+            updated = BASE_TIME + rng.randint(0, 10 ** 8)
+            self.trophy_titles.append({
+                "npCommunicationId": comm_id,
+                "fromUser": {"lastUpdateDate": _date(updated), "progress": 50}
+            })
+            self.trophies_by_title[comm_id] = [
+                {
+                    "trophyId": trophy_id,
+                    "trophyName": "Trophy {} of {}".format(trophy_id, index),
+                    "groupId": "default" if trophy_id < per_title * 3 // 4 else "001",
+                    "fromUser": {"earned": True, "earnedDate": _date(updated - trophy_id * 60)}
+                    if rng.random() < 0.6 else {"earned": False}
+                }
+                for trophy_id in range(per_title)
+            ]
+        self.trophy_titles.sort(key=lambda title: title["fromUser"]["lastUpdateDate"], reverse=True)
+        self.profiles = [
+            {"accountId": 10 ** 12 + index, "onlineId": "friend_{}".format(index)}
+            for index in range(self.friends)
+        ]
+        return self
+
+
+def _date(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
+def rewrite_url(url: str, port: int) -> str:
+    parts = urlsplit(url)
+    return "http://127.0.0.1:{}/{}{}{}".format(
+        port, parts.netloc, parts.path, "?" + parts.query if parts.query else ""
+    )
+
+
+def _page(request, items):
+    limit = int(request.query.get("limit", 100))
+    offset = int(request.query.get("offset", 0))
+    return items[offset:offset + limit]
+
+
+class FakePSN:
+    def __init__(self, account: Account, profile: LatencyProfile):
+        self.account = account
+        self.profile = profile
+        self.requests = Counter()
+        self._games_by_id = {game["titleId"]: game for game in account.games}
+
+    def application(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        prefix = "/{host}"
+        app.router.add_get("/__stats", self.stats)
+        app.router.add_post("/__reset", self.reset)
+        app.router.add_get(prefix + "/2.0/oauth/authorize", self.authorize)
+        app.router.add_get(prefix + "/userProfile/v1/users/me/profile2", self.own_profile)
+        app.router.add_get(prefix + "/userProfile/v1/users/me/friends/profiles2", self.friends)
+        app.router.add_get(prefix + "/v1/users/me/titles", self.game_list)
+        app.router.add_get(prefix + "/trophy/v1/apps/trophyTitles", self.game_details)
+        app.router.add_get(prefix + "/trophy/v1/trophyTitles", self.trophy_titles)
+        app.router.add_get(prefix + "/trophy/v1/trophyTitles/{comm_id}/trophyGroups", self.trophy_groups)
+        app.router.add_get(
+            prefix + "/trophy/v1/trophyTitles/{comm_id}/trophyGroups/{group_id}/trophies", self.trophies
+        )
+        return app
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        if request.path.startswith("/__"):
+            return await handler(request)
+        resource = request.match_info.route.resource
+        self.requests[resource.canonical if resource else request.path] += 1
+        self.requests["total"] += 1
+        profile = self.profile
+        delay = profile.base + random.random() * profile.jitter
+        if delay:
+            await asyncio.sleep(delay)
+        roll = random.random()
+        if roll < profile.timeout_rate:
+            await asyncio.sleep(profile.hang)
+        elif roll < profile.timeout_rate + profile.error_rate:
+            return web.Response(status=503)
+        elif roll < profile.timeout_rate + profile.error_rate + profile.throttle_rate:
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        return await handler(request)
+
+    async def stats(self, _):
+        return web.json_response(dict(self.requests))
+
+    async def reset(self, _):
+        self.requests.clear()
+        return web.json_response({})
+
+    async def authorize(self, request):
+        if "npsso" not in request.cookies:
+            return web.Response(status=401)
+        location = "https://my.playstation.com/auth/response.html#access_token=token-{}&expires_in=3600".format(
+            request.cookies["npsso"]
+        )
+        return web.Response(status=302, headers={"Location": location})
+
+    async def own_profile(self, _):
+        return web.json_response({"profile": {"accountId": "1234567890", "onlineId": "bench_user"}})
+
+    async def friends(self, request):
+        profiles = self.account.profiles
+        return web.json_response({"totalResults": len(profiles), "profiles": _page(request, profiles)})
+
+    async def game_list(self, request):
+        games = [{"titleId": game["titleId"], "name": game["name"]} for game in self.account.games]
+        return web.json_response({"totalResults": len(games), "titles": _page(request, games)})
+
+    async def game_details(self, request):
+        apps = []
+        for title_id in request.query["npTitleIds"].split(","):
+            game = self._games_by_id.get(title_id)
+            if game is None:
+                continue
+            apps.append({
+                "npTitleId": title_id,
+                "trophyTitles": [{"npCommunicationId": game["commId"]}] if game["commId"] else []
+            })
+        return web.json_response({"apps": apps})
+
+    async def trophy_titles(self, request):
+        titles = self.account.trophy_titles
+        return web.json_response({"totalResults": len(titles), "trophyTitles": _page(request, titles)})
+
+    async def trophy_groups(self, request):
+        comm_id = request.match_info["comm_id"]
+        trophies = self.account.trophies_by_title.get(comm_id, [])
+        groups = {}
+        for trophy in trophies:
+            group = groups.setdefault(trophy["groupId"], {"earned": 0, "last": None})
+            if trophy["fromUser"].get("earned"):
+                group["earned"] += 1
+                group["last"] = max(group["last"] or "", trophy["fromUser"]["earnedDate"])
+        return web.json_response({"trophyGroups": [
+            {
+                "trophyGroupId": group_id,
+                "fromUser": {
+                    "progress": group["earned"],
+                    "earnedTrophies": {"bronze": group["earned"]},
+                    **({"lastUpdateDate": group["last"]} if group["last"] else {})
+                }
+            }
+            for group_id, group in groups.items()
+        ]})
+
+    async def trophies(self, request):
+        comm_id = request.match_info["comm_id"]
+        group_id = request.match_info["group_id"]
+        trophies = self.account.trophies_by_title.get(comm_id)
+        if trophies is None:
+            return web.Response(status=404)
+        return web.json_response({"trophies": [
+            trophy for trophy in trophies if group_id == "all" or trophy["groupId"] == group_id
+        ]})
+
+
+def serve(port: int, account: Account, profile: LatencyProfile, ready=None):
+    async def start():
+        account.generate()
+        runner = web.AppRunner(FakePSN(account, profile).application(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        if ready is not None:
+            ready.set()
+        while True:
+            await asyncio.sleep(3600)
+
+    asyncio.run(start())
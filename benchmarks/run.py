@@ -0,0 +1,273 @@
+"""Offline performance benchmark of the plugin against a local fake PSN backend.
+
+    python benchmarks/run.py --titles 5000 --trophies 50000 --friends 2000 --latency typical
+    python benchmarks/run.py ... --save-baseline      # store the results as the new baseline
+    python benchmarks/run.py ... --tolerance 0.25     # fail when slower than the baseline by more than 25%
+
+Measures wall time, request count, peak RSS and event-loop lag of get_owned_games, import_games_achievements
+(cold and after a restart with the on-disk cache) and get_friends, with the post-login warm-up turned off, and of
+the login together with the warm-up on its own.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import aiohttp  # noqa: E402
+
+import fake_psn  # noqa: E402
+import plugin as plugin_module  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+ENDPOINT_NAMES = (
+    "OAUTH_TOKEN_URL", "GAME_DETAILS_URL", "GAME_LIST_URL", "TROPHY_TITLES_URL", "TROPHY_GROUPS_URL",
+    "EARNED_TROPHIES_PAGE", "USER_INFO_URL", "FRIENDS_URL"
+)
+# lower is better for all of them
+COMPARED_METRICS = ("wall_time", "requests", "peak_rss_kb", "loop_lag_max")
+
+
+def patch_endpoints(port):
+    # the plugin imports these on first use, their endpoints have to be patched before that
+    import http_client
+    import psn_client
+
+    src_dir = os.path.realpath(SRC_DIR)
+    modules = {http_client, psn_client}
+    for module in list(sys.modules.values()):
+        module_file = getattr(module, "__file__", None)
+        if module_file and os.path.dirname(os.path.realpath(module_file)) == src_dir:
+            modules.add(module)
+    for module in modules:
+        for name in ENDPOINT_NAMES:
+            value = getattr(module, name, None)
+            if isinstance(value, str) and value.startswith("https://"):
+                setattr(module, name, fake_psn.rewrite_url(value, port))
+
+
+class BenchmarkPlugin(plugin_module.PSNPlugin):
+    # the warm-up after login would otherwise be counted against the operations measured next
+    def __init__(self, warm_up=False):
+        super().__init__(None, None, None)
+        self.imported = {}
+        self.failed = {}
+        self._warm_up_enabled = warm_up
+
+    def _start_warm_up(self):
+        if self._warm_up_enabled:
+            super()._start_warm_up()
+
+    async def authenticate_and_warm_up(self):
+        await self.authenticate({"npsso": "benchmark"})
+        if self._warm_up_task is not None:
+            await self._warm_up_task
+
+    def game_achievements_import_success(self, game_id, achievements):
+        self.imported[game_id] = len(achievements)
+
+    def game_achievements_import_failure(self, game_id, error):
+        self.failed[game_id] = error
+
+    def lost_authentication(self):
+        logging.error("Authentication lost during the benchmark")
+
+
+class LoopLagProbe:
+    def __init__(self, interval=0.005):
+        self._interval = interval
+        self._samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self._interval)
+            self._samples.append(time.perf_counter() - start - self._interval)
+
+    def __enter__(self):
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def __exit__(self, *_):
+        self._task.cancel()
+
+    def summary(self):
+        if not self._samples:
+            return {"loop_lag_max": 0, "loop_lag_p99": 0}
+        samples = sorted(self._samples)
+        return {
+            "loop_lag_max": round(samples[-1], 4),
+            "loop_lag_p99": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 4)
+        }
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+async def measure(control, port, coroutine_factory):
+    base = "http://127.0.0.1:{}".format(port)
+    await control.post(base + "/__reset")
+    with LoopLagProbe() as probe:
+        start = time.perf_counter()
+        result = await coroutine_factory()
+        wall_time = time.perf_counter() - start
+    async with control.get(base + "/__stats") as response:
+        requests = (await response.json()).get("total", 0)
+    return result, {
+        "wall_time": round(wall_time, 3),
+        "requests": requests,
+        "peak_rss_kb": peak_rss_kb(),
+        **probe.summary()
+    }
+
+
+async def run_benchmark(port, cache_dir):
+    plugin_module.default_cache_dir = lambda: cache_dir
+    results = {}
+    async with aiohttp.ClientSession() as control:
+        plugin = BenchmarkPlugin()
+        await plugin.authenticate({"npsso": "benchmark"})
+
+        games, results["get_owned_games"] = await measure(control, port, plugin.get_owned_games)
+        game_ids = [game.game_id for game in games]
+        results["get_owned_games"]["games"] = len(games)
+
+        _, results["import_games_achievements"] = await measure(
+            control, port, lambda: plugin.import_games_achievements(game_ids)
+        )
+        results["import_games_achievements"]["imported"] = len(plugin.imported)
+        results["import_games_achievements"]["failed"] = len(plugin.failed)
+
+        friends, results["get_friends"] = await measure(control, port, plugin.get_friends)
+        results["get_friends"]["friends"] = len(friends)
+        plugin.shutdown()
+
+        # a restart served from the on-disk cache
+        plugin = BenchmarkPlugin()
+        await plugin.authenticate({"npsso": "benchmark"})
+        _, results["import_games_achievements_warm"] = await measure(
+            control, port, lambda: plugin.import_games_achievements(game_ids)
+        )
+        results["import_games_achievements_warm"]["imported"] = len(plugin.imported)
+        plugin.shutdown()
+
+        # login followed by the warm-up, on its own cold cache
+        plugin_module.default_cache_dir = lambda: os.path.join(cache_dir, "warm_up")
+        plugin = BenchmarkPlugin(warm_up=True)
+        _, results["warm_up"] = await measure(control, port, plugin.authenticate_and_warm_up)
+        plugin.shutdown()
+        await asyncio.sleep(0.1)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for operation, metrics in results.items():
+        reference = baseline.get(operation, {})
+        for metric in COMPARED_METRICS:
+            value, expected = metrics.get(metric), reference.get(metric)
+            if value is None or not expected:
+                continue
+            change = (value - expected) / expected
+            marker = ""
+            if change > tolerance:
+                marker = "  REGRESSION"
+                regressions.append((operation, metric))
+            print("{:34} {:14} {:>12} -> {:>12} ({:+.0%}){}".format(
+                operation, metric, expected, value, change, marker
+            ))
+    return regressions
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--titles", type=int, default=500)
+    parser.add_argument("--trophies", type=int, default=5000)
+    parser.add_argument("--friends", type=int, default=200)
+    parser.add_argument("--latency", choices=sorted(fake_psn.LATENCY_PROFILES), default="lan")
+    parser.add_argument("--runs", type=int, default=1, help="median of this many runs is reported")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    scenario = "{}-titles_{}-trophies_{}-friends_{}".format(args.titles, args.trophies, args.friends, args.latency)
+
+    port = free_port()
+    ready = multiprocessing.Event()
+    account = fake_psn.Account(titles=args.titles, trophies=args.trophies, friends=args.friends)
+    server = multiprocessing.Process(
+        target=fake_psn.serve,
+        args=(port, account, fake_psn.LATENCY_PROFILES[args.latency], ready),
+        daemon=True
+    )
+    server.start()
+    try:
+        if not ready.wait(60):
+            raise RuntimeError("Fake PSN backend did not start")
+        patch_endpoints(port)
+        runs = []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as cache_dir:
+                runs.append(asyncio.run(run_benchmark(port, cache_dir)))
+    finally:
+        server.terminate()
+
+    results = {
+        operation: {
+            metric: statistics.median(run[operation][metric] for run in runs)
+            if runs[0][operation][metric] is not None else None
+            for metric in runs[0][operation]
+        }
+        for operation in runs[0]
+    }
+    print(json.dumps({scenario: results}, indent=2))
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+
+    if args.save_baseline:
+        baselines[scenario] = results
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+        print("Baseline saved to {}".format(args.baseline))
+        return
+
+    if scenario not in baselines:
+        print("No baseline for {}".format(scenario))
+        return
+    if compare(results, baselines[scenario], args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
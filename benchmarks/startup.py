@@ -0,0 +1,125 @@
+"""Cold start benchmark of the plugin process.
+
+    python benchmarks/startup.py --runs 10
+    python benchmarks/startup.py --runs 10 --save-baseline   # store the results as the new baseline
+    python benchmarks/startup.py --runs 10 --tolerance 0.25  # fail when slower than the baseline by more than 25%
+
+Measures, each in a fresh interpreter, how long `import plugin` takes and the time from spawning `plugin.py` until
+it answers Galaxy's first JSON-RPC request (get_capabilities).
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_baseline.json")
+RESPONSE_TIMEOUT = 30
+
+IMPORT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import plugin
+print(json.dumps({"import_time": time.perf_counter() - start, "aiohttp_loaded": "aiohttp" in sys.modules}))
+"""
+
+
+def measure_import():
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_PROBE], cwd=SRC_DIR)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+async def measure_first_response():
+    connected = asyncio.get_event_loop().create_future()
+
+    def on_connect(reader, writer):
+        if not connected.done():
+            connected.set_result((reader, writer))
+
+    server = await asyncio.start_server(on_connect, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(SRC_DIR, "plugin.py"), "startup-benchmark", str(port),
+        cwd=SRC_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        reader, writer = await asyncio.wait_for(connected, RESPONSE_TIMEOUT)
+        connect_time = time.perf_counter() - start
+        request = {"jsonrpc": "2.0", "id": "1", "method": "get_capabilities", "params": {}}
+        writer.write((json.dumps(request) + "\n").encode())
+        await writer.drain()
+        # any answer counts, an error response is just as fast to produce as the capabilities
+        if not await asyncio.wait_for(reader.readline(), RESPONSE_TIMEOUT):
+            raise RuntimeError("Plugin closed the connection")
+        first_response = time.perf_counter() - start
+        writer.close()
+    finally:
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+        server.close()
+        await server.wait_closed()
+    return {"connect_time": connect_time, "first_response": first_response}
+
+
+def run(runs):
+    samples = []
+    for _ in range(runs):
+        sample = measure_import()
+        sample.update(asyncio.run(measure_first_response()))
+        samples.append(sample)
+    results = {
+        metric: round(statistics.median(sample[metric] for sample in samples), 4)
+        for metric in ("import_time", "connect_time", "first_response")
+    }
+    results["aiohttp_loaded"] = any(sample["aiohttp_loaded"] for sample in samples)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="median of this many runs is reported")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args.runs)
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print("Baseline saved to {}".format(args.baseline))
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline in {}".format(args.baseline))
+        return
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    regressions = []
+    for metric in ("import_time", "first_response"):
+        expected = baseline.get(metric)
+        if not expected:
+            continue
+        change = (results[metric] - expected) / expected
+        marker = ""
+        if change > args.tolerance:
+            marker = "  REGRESSION"
+            regressions.append(metric)
+        print("{:16} {:>10} -> {:>10} ({:+.0%}){}".format(metric, expected, results[metric], change, marker))
+    if results["aiohttp_loaded"]:
+        print("aiohttp is imported together with the plugin module")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Compares the memory taken by cached trophies in the compact representation against plain Achievement lists.
+
+    python benchmarks/trophy_memory.py                        # the default library sizes
+    python benchmarks/trophy_memory.py --sizes 1000x50 200x20 # games x earned trophies per game
+
+Every structure is built once before it is measured, so growth of interpreter-wide tables (interned strings and
+the like) is not counted against the structure measured first.
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from galaxy.api.types import Achievement  # noqa: E402
+from psn_client import TrophyGroupState, TrophyTitle  # noqa: E402
+from trophies import CompactTrophies, GameTrophies, TrophyGroup  # noqa: E402
+
+BASE_TIME = 1500000000
+
+
+def trophy_rows(game, count):
+    return [
+        (str(trophy_id), "Trophy {} of game {}".format(trophy_id, game), BASE_TIME + game * 1000 + trophy_id)
+        for trophy_id in range(count)
+    ]
+
+
+def achievement_lists(games, trophies):
+    return {
+        "NPWR{:05d}_00".format(game): [
+            Achievement(achievement_id=trophy_id, achievement_name=name, unlock_time=unlock_time)
+            for trophy_id, name, unlock_time in trophy_rows(game, trophies)
+        ]
+        for game in range(games)
+    }
+
+
+def compact_trophies(games, trophies):
+    state = TrophyGroupState(progress=100, earned=trophies, last_update_time=BASE_TIME)
+    return {
+        "NPWR{:05d}_00".format(game): GameTrophies({"default": TrophyGroup(
+            state, CompactTrophies.from_rows(trophy_rows(game, trophies))
+        )})
+        for game in range(games)
+    }
+
+
+def trophy_titles(games):
+    return {
+        "NPWR{:05d}_00".format(game): TrophyTitle("NPWR{:05d}_00".format(game), BASE_TIME + game)
+        for game in range(games)
+    }
+
+
+def measure(factory, *args):
+    factory(*args)
+    gc.collect()
+    tracemalloc.start()
+    data = factory(*args)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return size
+
+
+def parse_size(value):
+    games, trophies = value.lower().split("x")
+    return int(games), int(trophies)
+
+
+def report(games, trophies):
+    plain = measure(achievement_lists, games, trophies)
+    compact = measure(compact_trophies, games, trophies)
+    titles = measure(trophy_titles, games)
+    total = games * trophies
+
+    print("{} games, {} trophies".format(games, total))
+    print("List[Achievement]: {:>12,} B ({:.1f} B/trophy)".format(plain, plain / total))
+    print("CompactTrophies:   {:>12,} B ({:.1f} B/trophy)".format(compact, compact / total))
+    print("saved:             {:>12,} B ({:.0%})".format(plain - compact, 1 - compact / plain))
+    print("TrophyTitle index: {:>12,} B ({:.1f} B/title)".format(titles, titles / games))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--sizes", type=parse_size, nargs="+", default=[(200, 20), (1000, 50), (5000, 100)],
+        help="GAMESxTROPHIES, earned trophies per game"
+    )
+    args = parser.parse_args()
+
+    for index, (games, trophies) in enumerate(args.sizes):
+        if index:
+            print()
+        report(games, trophies)
+
+
+if __name__ == "__main__":
+    main()
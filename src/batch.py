@@ -0,0 +1,275 @@
+"""Headless sync of several PSN accounts on one event loop, results are written as JSON lines.
+
+    python batch.py credentials.json [--output results.jsonl] [--cache-dir DIR]
+
+credentials.json holds a list of npsso tokens, either as strings or as stored plugin credentials ({"npsso": ...}).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Hashable, List, Optional, TextIO
+
+from galaxy.api.errors import ApplicationError, InvalidCredentials
+
+from batcher import MicroBatcher
+from cache import Cache
+from http_client import AuthenticatedHttpClient, create_connector
+from persistent_cache import PersistentStore, StoreNamespace
+from psn_client import (
+    COMM_ID_NOT_AVAILABLE, MAX_TITLE_IDS_PER_REQUEST, CommunicationId, PSNClient, TitleId
+)
+from trophies import fetch_game_trophies
+
+# requests of all accounts together, handed out round-robin between accounts
+BATCH_CONCURRENCY = 16
+COMM_IDS_CACHE_SIZE = 8 * 1024 * 1024
+BATCH_STORE_FILE_NAME = "psn_batch_cache.jsonl"
+
+
+class FairScheduler:
+    def __init__(self, concurrency: int = BATCH_CONCURRENCY):
+        self._concurrency = concurrency
+        self._active = 0
+        # owners in round-robin order, each with its own waiters
+        self._waiters: Dict[Hashable, Deque[asyncio.Future]] = OrderedDict()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    async def acquire(self, owner: Hashable):
+        if self._active < self._concurrency and not self._waiters:
+            self._active += 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(owner, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was already handed over, pass it on
+                self.release()
+            else:
+                self._forget(owner, future)
+            raise
+
+    def _forget(self, owner: Hashable, future: asyncio.Future):
+        waiters = self._waiters.get(owner)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(future)
+        except ValueError:
+            pass
+        if not waiters:
+            del self._waiters[owner]
+
+    def release(self):
+        while self._waiters:
+            owner, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            del self._waiters[owner]
+            if waiters:
+                # the owner goes to the back of the line
+                self._waiters[owner] = waiters
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, owner: Hashable):
+        await self.acquire(owner)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class JsonLinesWriter:
+    def __init__(self, stream: TextIO):
+        self._stream = stream
+
+    def write(self, record: Dict):
+        self._stream.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._stream.flush()
+
+
+class AccountHttpClient(AuthenticatedHttpClient):
+    # every request takes its own slot, also pages the paginator fetches ahead
+    def __init__(self, scheduler: FairScheduler, owner: Hashable, auth_lost_callback, connector):
+        super().__init__(auth_lost_callback, connector=connector)
+        self._fair_scheduler = scheduler
+        self._owner = owner
+
+    async def get(self, url, *args, **kwargs):
+        async with self._fair_scheduler.slot(self._owner):
+            return await super().get(url, *args, **kwargs)
+
+
+class AccountSync:
+    def __init__(self, engine: "BatchSync", index: int, npsso: str):
+        self._engine = engine
+        self._index = index
+        self._npsso = npsso
+        self.http_client = AccountHttpClient(engine.scheduler, index, self._auth_lost, engine.connector)
+        self.psn_client = PSNClient(self.http_client)
+        self.user_id: Optional[str] = None
+
+    def _auth_lost(self):
+        logging.error("Authentication lost for account #%d", self._index)
+
+    def _emit(self, record_type: str, **fields):
+        self._engine.writer.write({"account": self.user_id or self._index, "type": record_type, **fields})
+
+    async def run(self):
+        try:
+            await self._sync()
+        except ApplicationError as error:
+            self._emit("error", error=repr(error))
+        except Exception as error:
+            logging.exception("Sync of account #%d failed", self._index)
+            self._emit("error", error=repr(error))
+        finally:
+            await self.http_client.logout()
+
+    async def _sync(self):
+        try:
+            await self.http_client.authenticate(self._npsso)
+            self.user_id, user_name = await self.psn_client.async_get_own_user_info()
+        except Exception:
+            raise InvalidCredentials()
+        self._emit("account", user_name=user_name)
+
+        # the lists do not depend on each other, page through them together
+        titles, trophy_titles, friends = await asyncio.gather(
+            self.psn_client.async_get_owned_games(),
+            self.psn_client.get_trophy_titles(),
+            self.psn_client.async_get_friends()
+        )
+        for friend in friends:
+            self._emit("friend", user_id=friend.user_id, user_name=friend.user_name)
+
+        comm_ids = await self._engine.get_game_communication_ids([title.game_id for title in titles])
+        last_updates = {title.communication_id: title.last_update_time for title in trophy_titles}
+        fetches = []
+        for title in titles:
+            comm_id = comm_ids.get(title.game_id, COMM_ID_NOT_AVAILABLE)
+            if comm_id == COMM_ID_NOT_AVAILABLE:
+                continue
+            self._emit("game", game_id=title.game_id, game_title=title.game_title, communication_id=comm_id)
+            if comm_id in last_updates:
+                fetches.append(self._sync_trophies(title.game_id, comm_id))
+            else:
+                self._emit("achievements", game_id=title.game_id, achievements=[])
+        await asyncio.gather(*fetches)
+        self._emit("done")
+
+    async def _sync_trophies(self, game_id: TitleId, comm_id: CommunicationId):
+        try:
+            trophies = await fetch_game_trophies(self.psn_client, comm_id, None)
+        except ApplicationError as error:
+            self._emit("error", game_id=game_id, error=repr(error))
+            return
+        self._emit("achievements", game_id=game_id, achievements=[
+            {"id": achievement_id, "name": achievement_name, "unlock_time": unlock_time}
+            for group in trophies.groups.values()
+            for achievement_id, achievement_name, unlock_time in group.trophies.rows()
+        ])
+
+
+class BatchSync:
+    def __init__(
+        self,
+        credentials: List[str],
+        writer: JsonLinesWriter,
+        concurrency: int = BATCH_CONCURRENCY,
+        cache_dir: Optional[str] = None
+    ):
+        self.writer = writer
+        self.scheduler = FairScheduler(concurrency)
+        # created in run(), aiohttp wants a running loop
+        self.connector = None
+        self._credentials = credentials
+        self._accounts: List[AccountSync] = []
+        self._store: Optional[PersistentStore] = None
+        self._cache_dir = cache_dir
+        # title -> communication ID mappings are the same for every account
+        self._comm_ids_cache = Cache(max_size=COMM_IDS_CACHE_SIZE)
+        self._comm_ids_batcher: MicroBatcher[TitleId, CommunicationId] = MicroBatcher(
+            self._fetch_communication_ids, MAX_TITLE_IDS_PER_REQUEST
+        )
+
+    def _comm_ids_client(self) -> PSNClient:
+        for account in self._accounts:
+            if account.user_id is not None and account.http_client.is_authenticated:
+                return account.psn_client
+        raise InvalidCredentials()
+
+    async def _fetch_communication_ids(self, title_ids: List[TitleId]) -> Dict[TitleId, CommunicationId]:
+        # the requests are scheduled as those of the account whose client sends them
+        delta = await self._comm_ids_client().async_get_game_communication_id_map(title_ids)
+        for title_id, comm_id in delta.items():
+            # a title is also reported as not a game when the response could not be parsed, that is not kept on disk
+            self._comm_ids_cache.update(title_id, comm_id, persist=comm_id != COMM_ID_NOT_AVAILABLE)
+        return delta
+
+    async def get_game_communication_ids(self, title_ids: List[TitleId]) -> Dict[TitleId, CommunicationId]:
+        result: Dict[TitleId, CommunicationId] = {}
+        misses = []
+        for title_id in title_ids:
+            comm_id = self._comm_ids_cache.get(title_id)
+            if comm_id:
+                result[title_id] = comm_id
+            else:
+                misses.append(title_id)
+        if misses:
+            result.update(await self._comm_ids_batcher.get(misses))
+        return result
+
+    async def run(self):
+        self.connector = create_connector()
+        if self._cache_dir is not None:
+            self._store = PersistentStore(os.path.join(self._cache_dir, BATCH_STORE_FILE_NAME))
+            self._comm_ids_cache.attach(StoreNamespace(self._store, "comm_ids"))
+        self._accounts = [AccountSync(self, index, npsso) for index, npsso in enumerate(self._credentials)]
+        try:
+            await asyncio.gather(*[account.run() for account in self._accounts])
+        finally:
+            self._comm_ids_batcher.cancel()
+            if self._store is not None:
+                self._store.close()
+            await self.connector.close()
+
+
+def load_credentials(path: str) -> List[str]:
+    with open(path) as credentials_file:
+        entries = json.load(credentials_file)
+    return [entry["npsso"] if isinstance(entry, dict) else str(entry) for entry in entries]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("credentials")
+    parser.add_argument("--output", help="defaults to stdout")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--cache-dir", help="keep communication IDs between runs in this directory")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        batch = BatchSync(load_credentials(args.credentials), JsonLinesWriter(output), args.concurrency, args.cache_dir)
+        asyncio.run(batch.run())
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Iterable, List, Optional, Set, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+# how long a partially filled batch waits for keys from other callers
+BATCH_WINDOW = 0.05
+
+
+class MicroBatcher(Generic[K, V]):
+    def __init__(
+        self,
+        fetch: Callable[[List[K]], Awaitable[Dict[K, V]]],
+        batch_size: int,
+        window: float = BATCH_WINDOW
+    ):
+        self._fetch = fetch
+        self._batch_size = batch_size
+        self._window = window
+        # keys either waiting for a batch or already in flight
+        self._pending: Dict[K, asyncio.Future] = {}
+        self._queue: List[K] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def get(self, keys: Iterable[K]) -> Dict[K, V]:
+        loop = asyncio.get_event_loop()
+        futures: Dict[K, asyncio.Future] = {}
+        for key in keys:
+            if key in futures:
+                continue
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = loop.create_future()
+                # failures are reported to the waiters, do not warn when there are none left
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+                self._queue.append(key)
+            futures[key] = future
+
+        while len(self._queue) >= self._batch_size:
+            self._dispatch(self._queue[:self._batch_size])
+            del self._queue[:self._batch_size]
+
+        if self._queue and self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._window, self.flush)
+
+        # shield: one caller giving up must not cancel lookups shared with others
+        values = await asyncio.gather(*[asyncio.shield(future) for future in futures.values()])
+        return dict(zip(futures.keys(), values))
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._queue:
+            self._dispatch(self._queue[:self._batch_size])
+            del self._queue[:self._batch_size]
+
+    def _dispatch(self, batch: List[K]):
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[K]):
+        try:
+            result = await self._fetch(batch)
+        except asyncio.CancelledError:
+            for key in batch:
+                self._pending.pop(key).cancel()
+            raise
+        except Exception as error:
+            for key in batch:
+                future = self._pending.pop(key)
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for key in batch:
+            future = self._pending.pop(key)
+            if not future.done():
+                future.set_result(result.get(key))
+
+    def cancel(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for key in self._queue:
+            self._pending.pop(key).cancel()
+        self._queue.clear()
+        for task in list(self._tasks):
+            task.cancel()
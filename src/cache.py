@@ -1,34 +1,134 @@
+import sys
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Optional
 
-from psn_client import UnixTimestamp
+from persistent_cache import StoreNamespace
+from parsers import UnixTimestamp
+
+def estimate_size(value: Any) -> int:
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, int, float)):
+        return size
+    if isinstance(value, dict):
+        return size + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(estimate_size(item) for item in value)
+    if hasattr(value, "__dict__"):
+        return size + estimate_size(vars(value))
+    slots = getattr(type(value), "__slots__", ())
+    return size + sum(estimate_size(getattr(value, slot)) for slot in slots if hasattr(value, slot))
 
 @dataclass
 class CacheEntry:
     value: Any
     timestamp: UnixTimestamp
+    size: int = 0
+    stored_at: float = 0
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
 
 class Cache:
-    def __init__(self):
-        self._entries: Dict[Any, CacheEntry] = {}
+    def __init__(
+        self,
+        backend: Optional[StoreNamespace] = None,
+        max_size: Optional[int] = None,
+        ttl: Optional[float] = None,
+        size_estimator: Callable[[Any], int] = estimate_size
+    ):
+        self._entries: Dict[Any, CacheEntry] = OrderedDict()
+        self._backend = backend
+        self._max_size = max_size
+        self._ttl = ttl
+        self._size_estimator = size_estimator
+        self._size = 0
+        self.stats = CacheStats()
+
+    def attach(self, backend: Optional[StoreNamespace]):
+        self._backend = backend
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def max_size(self) -> Optional[int]:
+        return self._max_size
+
+    def __len__(self):
+        return len(self._entries)
 
-    def get(self, key: Any, timestamp: UnixTimestamp):
+    def _expired(self, entry: CacheEntry) -> bool:
+        return self._ttl is not None and time.monotonic() - entry.stored_at > self._ttl
+
+    def _remove(self, key: Any):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+    def _insert(self, key: Any, value: Any, timestamp: UnixTimestamp) -> CacheEntry:
+        entry = CacheEntry(value, timestamp, self._size_estimator(value), time.monotonic())
+        self._entries[key] = entry
+        self._size += entry.size
+        self._evict()
+        return entry
+
+    def _evict(self):
+        if self._max_size is None:
+            return
+        # the most recently used entry stays even if it does not fit on its own
+        while self._size > self._max_size and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+            self.stats.evictions += 1
+
+    def _load(self, key: Any) -> Optional[CacheEntry]:
         entry: Optional[CacheEntry] = self._entries.get(key)
-        if entry is None:
-            return None
-        if entry.timestamp < timestamp:
+        if entry is not None and self._expired(entry):
+            self._remove(key)
+            self.stats.expirations += 1
+            entry = None
+        if entry is None and self._backend is not None:
+            record = self._backend.get(key)
+            if record is not None:
+                entry = self._insert(key, *record)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key: Any, timestamp: UnixTimestamp = UnixTimestamp(0)):
+        entry: Optional[CacheEntry] = self._load(key)
+        if entry is None or entry.timestamp < timestamp:
+            self.stats.misses += 1
             return None
+        self.stats.hits += 1
         return entry.value
 
-    def update(self, key: Any, value: Any, timestamp: UnixTimestamp):
-        entry: Optional[CacheEntry] = self._entries.get(key)
-        if entry is None:
-            self._entries[key] = CacheEntry(value, timestamp)
-        else:
-            if entry.timestamp < timestamp:
-                entry.value = value
-                entry.timestamp = timestamp
+    # returns whatever is cached regardless of its timestamp, without counting a lookup
+    def peek(self, key: Any):
+        entry: Optional[CacheEntry] = self._load(key)
+        return entry.value if entry is not None else None
+
+    # persist=False keeps the value for this session only
+    def update(self, key: Any, value: Any, timestamp: UnixTimestamp = UnixTimestamp(0), persist: bool = True):
+        entry: Optional[CacheEntry] = self._load(key)
+        if entry is not None:
+            if entry.timestamp >= timestamp:
+                return
+            self._remove(key)
+        self._insert(key, value, timestamp)
+        if persist and self._backend is not None:
+            self._backend.put(key, value, timestamp)
 
     def __iter__(self):
-        for key, entry in self._entries.items():
+        for key, entry in list(self._entries.items()):
             yield key, entry.value
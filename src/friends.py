@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+from galaxy.api.types import FriendInfo
+
+from parsers import UnixTimestamp
+from persistent_cache import StoreNamespace
+
+if TYPE_CHECKING:
+    from psn_client import PSNClient
+
+# a friends list younger than this is served without asking PSN
+FRIENDS_TTL = 15 * 60
+FRIENDS_RECORD_KEY = "list"
+
+FriendsListener = Callable[[List[FriendInfo], List[str]], None]
+
+
+def encode_friends(friends: Dict[str, FriendInfo]):
+    return [[friend.user_id, friend.user_name] for friend in friends.values()]
+
+
+def decode_friends(value) -> Dict[str, FriendInfo]:
+    return {user_id: FriendInfo(user_id=user_id, user_name=user_name) for user_id, user_name in value}
+
+
+class FriendsIndex:
+    def __init__(self, psn_client: "PSNClient", ttl: float = FRIENDS_TTL):
+        self._psn_client = psn_client
+        self._ttl = ttl
+        self._friends: Dict[str, FriendInfo] = {}
+        self._synced_at: Optional[float] = None  # wall clock, it is persisted
+        self._stored_at: Optional[float] = None
+        self._backend: Optional[StoreNamespace] = None
+        self._sync_task: Optional[asyncio.Future] = None
+        self._loaded = True
+        self._listener: Optional[FriendsListener] = None
+
+    @property
+    def friends(self) -> List[FriendInfo]:
+        return list(self._friends.values())
+
+    @property
+    def fresh(self) -> bool:
+        if not self._loaded:
+            self._load()
+        return self._synced_at is not None and time.time() - self._synced_at < self._ttl
+
+    def attach(self, backend: Optional[StoreNamespace]):
+        self._backend = backend
+        self._friends = {}
+        self._synced_at = self._stored_at = None
+        self._loaded = False
+
+    def listen(self, listener: Optional[FriendsListener]):
+        # called with (added, removed user ids) after a sync that changed a non-empty list
+        self._listener = listener
+
+    def _load(self):
+        self._loaded = True
+        if self._backend is None:
+            return
+        record = self._backend.get(FRIENDS_RECORD_KEY)
+        if record is None:
+            return
+        self._friends, self._synced_at = record
+        self._stored_at = self._synced_at
+
+    async def get(self) -> List[FriendInfo]:
+        if not self.fresh:
+            await self.sync()
+        return self.friends
+
+    async def sync(self):
+        if not self._loaded:
+            self._load()
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.ensure_future(self._sync())
+        await asyncio.shield(self._sync_task)
+
+    async def _sync(self):
+        friends = {friend.user_id: friend for friend in await self._psn_client.async_get_friends()}
+        known = self._friends
+        added = [friend for user_id, friend in friends.items() if known.get(user_id) != friend]
+        removed = [user_id for user_id in known if user_id not in friends]
+        initial = self._synced_at is None
+
+        self._friends = friends
+        self._synced_at = time.time()
+        # the store is append-only, unchanged lists are written again only to keep the timestamp usable
+        if self._backend is not None and (added or removed or self._stored_at is None
+                                          or self._synced_at - self._stored_at > self._ttl / 2):
+            self._backend.put(FRIENDS_RECORD_KEY, friends, UnixTimestamp(int(self._synced_at)))
+            self._stored_at = self._synced_at
+
+        if added or removed:
+            logging.debug("Friends changed: %d added, %d removed", len(added), len(removed))
+            if not initial and self._listener is not None:
+                self._listener(added, removed)
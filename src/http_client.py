@@ -1,6 +1,16 @@
 import aiohttp
+import asyncio
+import certifi
+import json
 import logging
+import ssl
+import time
 
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import partial
+from http import HTTPStatus
+from typing import Any, Dict, Iterable, Optional, Tuple
 from urllib.parse import parse_qsl, urlsplit
 
 from galaxy.api.errors import (
@@ -10,10 +20,23 @@ from galaxy.api.errors import (
     BackendTimeout,
     NetworkError,
     InvalidCredentials,
+    TooManyRequests,
     UnknownBackendResponse
 )
 from galaxy.http import HttpClient
 
+from metrics import METRICS
+from rate_limiter import RequestScheduler, parse_retry_after
+
+# optional faster JSON backends, both accept bytes and raise ValueError subclasses
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        json_loads = json.loads
+
 OAUTH_LOGIN_REDIRECT_URL = "https://my.playstation.com/auth/response.html"
 
 # TODO: we probably do not need all these scopes
@@ -56,31 +79,153 @@ OAUTH_TOKEN_URL = OAUTH_URL_BASE + "?requestID=iframe_request_c37ac45d-d6f2-4585
 
 
 DEFAULT_TIMEOUT = 30
-CONNECTION_LIMIT = 20
+CONNECTION_LIMIT = 30
+# leaves connections for the profile and auth hosts while trophies are being imported
+CONNECTION_LIMIT_PER_HOST = 12
+DNS_CACHE_TTL = 10 * 60
+KEEPALIVE_TIMEOUT = 60
+PREWARM_TIMEOUT = 10
+# bodies larger than this are decoded in the default executor to keep the event loop responsive
+EXECUTOR_DECODE_THRESHOLD = 256 * 1024
+# memory budget for bodies kept for conditional requests
+RESPONSE_CACHE_SIZE = 8 * 1024 * 1024
+# attempts per request when the backend answers 429
+MAX_THROTTLED_ATTEMPTS = 3
+# renew the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 120
 
 
 def paginate_url(url, limit, offset=0):
-    return url + "&limit={limit}&offset={offset}".format(limit=limit, offset=offset)
+    separator = "&" if "?" in url else "?"
+    return url + separator + "limit={limit}&offset={offset}".format(limit=limit, offset=offset)
+
+
+def create_connector(**kwargs) -> aiohttp.TCPConnector:
+    ssl_context = ssl.create_default_context(cafile=certifi.where())
+    kwargs.setdefault("limit", CONNECTION_LIMIT)
+    kwargs.setdefault("limit_per_host", CONNECTION_LIMIT_PER_HOST)
+    kwargs.setdefault("ttl_dns_cache", DNS_CACHE_TTL)
+    kwargs.setdefault("keepalive_timeout", KEEPALIVE_TIMEOUT)
+    kwargs.setdefault("enable_cleanup_closed", True)
+    return aiohttp.TCPConnector(ssl=ssl_context, **kwargs)
+
+
+def create_session(connector: Optional[aiohttp.TCPConnector] = None) -> aiohttp.ClientSession:
+    # a shared connector stays open when the session is closed
+    return aiohttp.ClientSession(
+        connector=connector or create_connector(),
+        connector_owner=connector is None,
+        timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT),
+        raise_for_status=True
+    )
+
+
+async def run_in_executor(method, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(method, *args, **kwargs))
+
+
+async def decode_json(body: bytes):
+    if not body or body.isspace():
+        return None
+    if len(body) > EXECUTOR_DECODE_THRESHOLD:
+        return await run_in_executor(json_loads, body)
+    return json_loads(body)
+
+
+@dataclass
+class CachedResponse:
+    # the raw body is kept, decoded JSON takes several times as much memory and is rarely needed again
+    etag: Optional[str]
+    last_modified: Optional[str]
+    body: bytes
+
+    @property
+    def size(self) -> int:
+        return len(self.body)
+
+    def validators(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE):
+        self._entries: Dict[Any, CachedResponse] = OrderedDict()
+        self._max_size = max_size
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url: str, params: Optional[Dict] = None):
+        return url, tuple(sorted(params.items())) if params else ()
+
+    def get(self, key) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry: CachedResponse):
+        self.discard(key)
+        if entry.size > self._max_size:
+            return
+        self._entries[key] = entry
+        self._size += entry.size
+        while self._size > self._max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    # HttpClient raises TooManyRequests while handling aiohttp's ClientResponseError, which carries the headers
+    headers = getattr(error.__context__, "headers", None)
+    return parse_retry_after(headers.get("Retry-After")) if headers else None
 
 
 class AuthenticatedHttpClient(HttpClient):
-    def __init__(self, auth_lost_callback):
+    # HttpClient.__init__ is not called, its session has a single connection limit for all hosts
+    def __init__(self, auth_lost_callback, connector: Optional[aiohttp.TCPConnector] = None):
         self._access_token = None
         self._refresh_token = None
         self._auth_lost_callback = auth_lost_callback
-        super().__init__(limit=CONNECTION_LIMIT, timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT))
+        self._refresh_task: Optional[asyncio.Future] = None
+        self._rejected_token = None
+        self._refresh_handle: Optional[asyncio.TimerHandle] = None
+        self._scheduler = RequestScheduler()
+        self._response_cache = ResponseCache()
+        self._session = create_session(connector)
 
     @property
     def is_authenticated(self):
         return self._access_token is not None
 
+    @property
+    def scheduler(self) -> RequestScheduler:
+        return self._scheduler
+
+    @property
+    def response_cache(self) -> ResponseCache:
+        return self._response_cache
+
     def _auth_lost(self):
         self._access_token = None
         self._refresh_token = None
+        self._cancel_scheduled_refresh()
         if self._auth_lost_callback:
             self._auth_lost_callback()
 
-    async def get_access_token(self, refresh_token):
+    async def _fetch_access_token(self, refresh_token) -> Tuple[str, Optional[int]]:
         response = None
         try:
             response = await super().request(
@@ -89,62 +234,179 @@ class AuthenticatedHttpClient(HttpClient):
                 cookies={"npsso": refresh_token},
                 allow_redirects=False
             )
-            return dict(parse_qsl(urlsplit(response.headers["Location"]).fragment))["access_token"]
+            fragment = dict(parse_qsl(urlsplit(response.headers["Location"]).fragment))
+            expires_in = fragment.get("expires_in")
+            return fragment["access_token"], int(expires_in) if expires_in else None
         except AuthenticationRequired:
             raise InvalidCredentials()
-        except (KeyError, IndexError):
+        except (KeyError, IndexError, ValueError):
             raise UnknownBackendResponse()
         finally:
             if response:
                 response.close()
 
+    async def get_access_token(self, refresh_token):
+        access_token, _ = await self._fetch_access_token(refresh_token)
+        return access_token
+
     async def authenticate(self, refresh_token):
         self._refresh_token = refresh_token
-        self._access_token = await self.get_access_token(self._refresh_token)
-        if not self._access_token:
+        access_token, expires_in = await self._fetch_access_token(self._refresh_token)
+        if not access_token:
             raise Exception("Invalid access token")
+        self._set_access_token(access_token, expires_in)
+
+    def _set_access_token(self, access_token, expires_in: Optional[int]):
+        self._access_token = access_token
+        self._schedule_refresh(expires_in)
+
+    def _schedule_refresh(self, expires_in: Optional[int]):
+        self._cancel_scheduled_refresh()
+        if not expires_in:
+            return
+        delay = max(expires_in - TOKEN_REFRESH_MARGIN, expires_in / 2)
+        self._refresh_handle = asyncio.get_event_loop().call_later(delay, self._refresh_in_background)
+
+    def _cancel_scheduled_refresh(self):
+        if self._refresh_handle is not None:
+            self._refresh_handle.cancel()
+            self._refresh_handle = None
 
-    async def _refresh_access_token(self):
+    def _refresh_in_background(self):
+        self._refresh_handle = None
+        if not self._refresh_token:
+            return
+
+        def log_failure(task):
+            if not task.cancelled() and task.exception():
+                logging.warning("Proactive token refresh failed: %r", task.exception())
+
+        self._start_refresh().add_done_callback(log_failure)
+
+    def _start_refresh(self) -> asyncio.Future:
+        # single flight: every caller waits for the same token request
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._do_refresh_access_token())
+        return self._refresh_task
+
+    async def _do_refresh_access_token(self):
         try:
-            self._access_token = await self.get_access_token(self._refresh_token)
-            if not self._access_token:
+            access_token, expires_in = await self._fetch_access_token(self._refresh_token)
+            if not access_token:
                 raise Exception
+            self._set_access_token(access_token, expires_in)
         except (BackendNotAvailable, BackendTimeout, BackendError, NetworkError):
             logging.warning("Failed to refresh token for independent reasons")
             raise
         except Exception:
             logging.exception("Failed to refresh token")
-            if self._auth_lost_callback:
-                self._auth_lost_callback()
+            self._auth_lost()
             raise AuthenticationRequired()
 
+    async def _refresh_access_token(self, rejected_token=None):
+        if rejected_token is not None and rejected_token != self._access_token:
+            # somebody else has already replaced the rejected token
+            return
+        self._rejected_token = rejected_token
+        await asyncio.shield(self._start_refresh())
+
     async def request(self, method, *args, **kwargs):
         if not self._access_token:
             raise AuthenticationRequired()
 
+        if self._access_token == self._rejected_token and self._refresh_task is not None \
+                and not self._refresh_task.done():
+            # the current token is known to be rejected, do not waste a round trip on it
+            await asyncio.shield(self._refresh_task)
+
+        access_token = self._access_token
         try:
             return await self._request(method, *args, **kwargs)
         except AuthenticationRequired:
-            await self._refresh_access_token()
+            await self._refresh_access_token(access_token)
             return await self._request(method, *args, **kwargs)
 
     async def _request(self, method, *args, **kwargs):
-        headers = kwargs.setdefault("headers", {})
-        headers["authorization"] = "Bearer " + self._access_token
-        return await super().request(method, *args, **kwargs)
+        for attempt in range(1, MAX_THROTTLED_ATTEMPTS + 1):
+            async with self._scheduler.slot(kwargs["url"]) as limiter:
+                if not self._access_token:
+                    raise AuthenticationRequired()
+                headers = kwargs.setdefault("headers", {})
+                headers["authorization"] = "Bearer " + self._access_token
+                start = time.perf_counter()
+                try:
+                    response = await super().request(method, *args, **kwargs)
+                except Exception as error:
+                    METRICS.record_request(kwargs["url"], time.perf_counter() - start, error)
+                    if isinstance(error, TooManyRequests):
+                        limiter.on_throttled(_retry_after(error))
+                        if attempt == MAX_THROTTLED_ATTEMPTS:
+                            raise
+                        logging.info("Throttled by %s, backing off", limiter.host)
+                        continue
+                    if isinstance(error, (BackendTimeout, BackendNotAvailable)):
+                        limiter.on_congestion()
+                    raise
+                METRICS.record_request(kwargs["url"], time.perf_counter() - start)
+                limiter.on_success()
+                return response
 
     async def get(self, url, *args, **kwargs):
+        cache_key = ResponseCache.key(url, kwargs.get("params"))
+        cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), **cached.validators()}
+
         response = await self.request("GET", *args, url=url, **kwargs)
+        if response.status == HTTPStatus.NOT_MODIFIED and cached is not None:
+            response.release()
+            self._response_cache.hits += 1
+            METRICS.record_response(url, 0, not_modified=True)
+            logging.debug("Not modified:\n{url}".format(url=url))
+            return await decode_json(cached.body)
+
+        body = await response.read()
+        self._response_cache.misses += 1
+        METRICS.record_response(url, len(body))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Response for:\n{url}\n{data}".format(url=url, data=body.decode("utf-8", "replace")))
         try:
-            logging.debug("Response for:\n{url}\n{data}".format(url=url, data=await response.text()))
-            return await response.json()
+            data = await decode_json(body)
         except ValueError:
             logging.exception("Invalid response data for:\n{url}".format(url=url))
             raise UnknownBackendResponse()
 
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self._response_cache.put(cache_key, CachedResponse(etag, last_modified, body))
+        else:
+            self._response_cache.discard(cache_key)
+        return data
+
     async def post(self, url, *args, **kwargs):
         logging.debug("Sending data:\n{url}".format(url=url))
         return await self.request("POST", *args, url=url, **kwargs)
 
+    async def prewarm(self, urls: Iterable[str]):
+        # resolves and opens one keep-alive connection per host, so the first real requests skip DNS and TLS setup
+        async def connect(origin):
+            try:
+                async with self._session.head(
+                    origin,
+                    allow_redirects=False,
+                    raise_for_status=False,
+                    timeout=aiohttp.ClientTimeout(total=PREWARM_TIMEOUT)
+                ):
+                    pass
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                logging.debug("Cannot prewarm connection to %s: %r", origin, error)
+
+        origins = {"{0.scheme}://{0.netloc}/".format(urlsplit(url)) for url in urls}
+        await asyncio.gather(*[connect(origin) for origin in origins])
+
     async def logout(self):
+        self._cancel_scheduled_refresh()
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
         await self._session.close()
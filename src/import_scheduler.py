@@ -0,0 +1,99 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Awaitable, Callable, Generic, Iterable, List, Optional, Set, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# games imported at the same time, the per-host limiter still decides how many requests are on the wire
+IMPORT_CONCURRENCY = 10
+# workers start this long after the first job is queued, so jobs of runs submitted together are ordered together
+IMPORT_GATHER_WINDOW = 0.05
+
+
+# jobs of all runs share one queue and a bounded pool of workers, lowest priority value first; a job reports its
+# own result, run() waits until all of its jobs are done and returns the ones cancelled before finishing
+class ImportScheduler(Generic[T]):
+    def __init__(
+        self,
+        process: Callable[[T], Awaitable[None]],
+        concurrency: int = IMPORT_CONCURRENCY,
+        gather_window: float = IMPORT_GATHER_WINDOW
+    ):
+        self._process = process
+        self._concurrency = concurrency
+        self._gather_window = gather_window
+        self._queue: List[Tuple[int, int, T, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._workers: Set[asyncio.Task] = set()
+        self._start_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    @property
+    def active(self) -> int:
+        # a finished worker stays in the set until its done callback runs
+        return sum(not worker.done() for worker in self._workers)
+
+    async def run(self, jobs: Iterable[Tuple[int, T]]) -> List[T]:
+        loop = asyncio.get_event_loop()
+        scheduled = []
+        futures = []
+        for priority, job in jobs:
+            future = loop.create_future()
+            heapq.heappush(self._queue, (priority, next(self._counter), job, future))
+            scheduled.append(job)
+            futures.append(future)
+        if self.active:
+            self._start_workers()
+        elif self._start_handle is None:
+            # nothing runs yet, wait for the other runs started together before picking the first jobs
+            self._start_handle = loop.call_later(self._gather_window, self._start_workers)
+
+        try:
+            await asyncio.gather(*futures, return_exceptions=True)
+            return [job for job, future in zip(scheduled, futures) if future.cancelled()]
+        finally:
+            # jobs of a cancelled run still queued are skipped by the workers
+            for future in futures:
+                future.cancel()
+
+    def _start_workers(self):
+        if self._start_handle is not None:
+            self._start_handle.cancel()
+            self._start_handle = None
+        for _ in range(min(len(self._queue), self._concurrency - self.active)):
+            worker = asyncio.ensure_future(self._work())
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+
+    async def _work(self):
+        while self._queue:
+            _, _, job, future = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as error:
+                logging.exception("Import job failed")
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                if not future.done():
+                    future.set_result(None)
+
+    def cancel(self):
+        if self._start_handle is not None:
+            self._start_handle.cancel()
+            self._start_handle = None
+        for _, _, _, future in self._queue:
+            future.cancel()
+        self._queue.clear()
+        for worker in list(self._workers):
+            worker.cancel()
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import asdict
+from typing import Callable, Dict, Optional
+from urllib.parse import urlsplit
+
+# upper bounds in seconds, the last bucket takes everything above
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_TEMPLATE_RULES = [
+    (re.compile(r"/NPWR\d+_\d+"), "/{communication_id}"),
+    (re.compile(r"/trophyGroups/[^/]+/trophies"), "/trophyGroups/{trophy_group_id}/trophies"),
+    (re.compile(r"/users/[^/]+/"), "/users/{user_id}/"),
+]
+
+
+def url_template(url: str) -> str:
+    parts = urlsplit(url)
+    path = parts.path
+    for pattern, replacement in _TEMPLATE_RULES:
+        path = pattern.sub(replacement, path)
+    return parts.netloc + path
+
+
+class Histogram:
+    __slots__ = ("bounds", "buckets", "count", "total", "max")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the quantile
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, bucket in zip(self.bounds, self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 4) if self.count else 0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": round(self.max, 4),
+            "buckets": dict(zip([str(bound) for bound in self.bounds] + ["inf"], self.buckets))
+        }
+
+
+class EndpointStats:
+    __slots__ = ("requests", "errors", "bytes", "not_modified", "latency")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors: Dict[str, int] = {}
+        self.bytes = 0
+        self.not_modified = 0
+        self.latency = Histogram()
+
+    def snapshot(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "errors": dict(self.errors),
+            "bytes": self.bytes,
+            "not_modified": self.not_modified,
+            "latency": self.latency.snapshot()
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._started = time.time()
+        self._endpoints: Dict[str, EndpointStats] = {}
+        self._stages: Dict[str, Histogram] = {}
+        self._caches: Dict[str, Callable[[], Dict]] = {}
+        self.loop_lag = Histogram()
+
+    def endpoint(self, url: str) -> EndpointStats:
+        template = url_template(url)
+        stats = self._endpoints.get(template)
+        if stats is None:
+            stats = self._endpoints[template] = EndpointStats()
+        return stats
+
+    def record_request(self, url: str, latency: float, error: Optional[Exception] = None):
+        stats = self.endpoint(url)
+        stats.requests += 1
+        stats.latency.observe(latency)
+        if error is not None:
+            name = type(error).__name__
+            stats.errors[name] = stats.errors.get(name, 0) + 1
+
+    def record_response(self, url: str, size: int, not_modified: bool = False):
+        stats = self.endpoint(url)
+        stats.bytes += size
+        if not_modified:
+            stats.not_modified += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram = self._stages.get(name)
+            if histogram is None:
+                histogram = self._stages[name] = Histogram()
+            histogram.observe(time.perf_counter() - start)
+
+    def register_cache(self, name: str, stats):
+        # anything with hits/misses counters, CacheStats in particular
+        def snapshot():
+            data = asdict(stats) if hasattr(stats, "__dataclass_fields__") else {}
+            data.update(hits=stats.hits, misses=stats.misses)
+            lookups = stats.hits + stats.misses
+            data["hit_ratio"] = round(stats.hits / lookups, 4) if lookups else 0
+            return data
+        self._caches[name] = snapshot
+
+    def snapshot(self) -> Dict:
+        return {
+            "timestamp": int(time.time()),
+            "uptime": int(time.time() - self._started),
+            "endpoints": {template: stats.snapshot() for template, stats in sorted(self._endpoints.items())},
+            "stages": {name: histogram.snapshot() for name, histogram in sorted(self._stages.items())},
+            "caches": {name: snapshot() for name, snapshot in sorted(self._caches.items())},
+            "loop_lag": self.loop_lag.snapshot()
+        }
+
+    def log(self):
+        logging.info("metrics %s", json.dumps(self.snapshot(), separators=(",", ":")))
+
+    def dump(self, path: str):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = path + ".tmp"
+            with open(temporary, "w") as snapshot_file:
+                json.dump(self.snapshot(), snapshot_file, indent=1)
+            os.replace(temporary, path)
+        except OSError:
+            logging.exception("Cannot write metrics snapshot to %s", path)
+
+
+class LoopLagProbe:
+    def __init__(self, histogram: Histogram, interval: float = 0.25):
+        self._histogram = histogram
+        self._interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self._interval)
+            self._histogram.observe(max(0.0, loop.time() - start - self._interval))
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+METRICS = Metrics()
+
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from galaxy.api.types import Game
+
+from parsers import TitleId
+
+if TYPE_CHECKING:
+    from psn_client import PSNClient
+
+GamesFilter = Callable[[List[Game]], Awaitable[List[Game]]]
+GamesDelta = Tuple[List[Game], List[TitleId]]
+
+
+class OwnedGamesIndex:
+    def __init__(self, psn_client: "PSNClient", filter_games: GamesFilter):
+        self._psn_client = psn_client
+        self._filter_games = filter_games
+        # every title on the list, including the ones without trophies that are not reported as games
+        self._titles: Set[TitleId] = set()
+        self._games: Dict[TitleId, Game] = {}
+        self._synced = False
+        self._sync_task: Optional[asyncio.Future] = None
+
+    @property
+    def games(self) -> List[Game]:
+        return list(self._games.values())
+
+    @property
+    def synced(self) -> bool:
+        return self._synced
+
+    async def sync(self, full: bool = False) -> GamesDelta:
+        # returns games added to and title ids removed from the index
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.ensure_future(
+                self._full_sync() if full or not self._synced else self._incremental_sync()
+            )
+        return await asyncio.shield(self._sync_task)
+
+    async def _full_sync(self) -> GamesDelta:
+        titles = await self._psn_client.async_get_owned_games()
+        games = {game.game_id: game for game in await self._filter_games(titles)}
+        added = [game for game_id, game in games.items() if game_id not in self._games]
+        removed = [game_id for game_id in self._games if game_id not in games]
+        self._titles = {title.game_id for title in titles}
+        self._games = games
+        self._synced = True
+        return added, removed
+
+    async def _incremental_sync(self) -> GamesDelta:
+        # the list is sorted by last played date, titles in front of the first known one are new
+        new_titles: List[Game] = []
+        offset = 0
+        while True:
+            total, titles = await self._psn_client.async_get_owned_games_page(offset)
+            known = next((index for index, title in enumerate(titles) if title.game_id in self._titles), None)
+            new_titles.extend(titles if known is None else titles[:known])
+            offset += len(titles)
+            if known is not None or not titles or offset >= total:
+                break
+
+        if total != len(self._titles) + len(new_titles):
+            # something was removed, or new titles are hidden behind a known one that was played again
+            logging.debug("Owned games count changed from %d to %d, rescanning", len(self._titles), total)
+            return await self._full_sync()
+
+        added = [game for game in await self._filter_games(new_titles) if game.game_id not in self._games]
+        self._titles.update(title.game_id for title in new_titles)
+        self._games.update((game.game_id, game) for game in added)
+        return added, []
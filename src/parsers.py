@@ -0,0 +1,142 @@
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from functools import lru_cache
+from typing import Dict, List, NewType, Optional, Tuple
+
+from galaxy.api.consts import LicenseType
+from galaxy.api.types import FriendInfo, Game, LicenseInfo
+
+CommunicationId = NewType("CommunicationId", str)
+TitleId = NewType("TitleId", str)
+UnixTimestamp = NewType("UnixTimestamp", int)
+TrophyGroupId = NewType("TrophyGroupId", str)
+
+ALL_TROPHY_GROUPS = TrophyGroupId("all")
+DEFAULT_TROPHY_GROUP = TrophyGroupId("default")
+COMM_ID_NOT_AVAILABLE = CommunicationId("-N/A-")
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+_EPOCH = date(1970, 1, 1)
+
+TrophyRow = Tuple[str, str, UnixTimestamp]
+
+
+@dataclass
+class TrophyTitle:
+    __slots__ = ("communication_id", "last_update_time")
+    communication_id: CommunicationId
+    last_update_time: UnixTimestamp
+
+
+@dataclass(frozen=True)
+class TrophyGroupState:
+    __slots__ = ("progress", "earned", "last_update_time")
+    progress: int
+    earned: int
+    last_update_time: Optional[UnixTimestamp]
+
+
+def parse_timestamp(earned_date) -> UnixTimestamp:
+    dt = datetime.strptime(earned_date, TIMESTAMP_FORMAT)
+    dt = datetime.combine(dt.date(), dt.time(), timezone.utc)
+    return UnixTimestamp(dt.timestamp())
+
+
+@lru_cache(maxsize=4096)
+def _day_start(day: str) -> int:
+    # raises ValueError for dates that do not exist
+    return (date(int(day[0:4]), int(day[5:7]), int(day[8:10])) - _EPOCH).days * 86400
+
+
+def _strict_parse_timestamp(value) -> UnixTimestamp:
+    # whole seconds like the fast path, the values end up in integer arrays
+    return UnixTimestamp(int(parse_timestamp(value)))
+
+
+def fast_parse_timestamp(value: str) -> UnixTimestamp:
+    # fixed layout "YYYY-MM-DDTHH:MM:SSZ", anything else goes through the strict strptime parser
+    try:
+        if len(value) != 20 or value[4] != "-" or value[7] != "-" or value[10] != "T" \
+                or value[13] != ":" or value[16] != ":" or value[19] != "Z":
+            return _strict_parse_timestamp(value)
+        digits = value[0:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19]
+        if not (digits.isdigit() and digits.isascii()):
+            return _strict_parse_timestamp(value)
+    except TypeError:
+        return _strict_parse_timestamp(value)
+
+    hour, minute, second = int(value[11:13]), int(value[14:16]), int(value[17:19])
+    if hour > 23 or minute > 59 or second > 59:
+        return _strict_parse_timestamp(value)
+    return UnixTimestamp(_day_start(value[0:10]) + hour * 3600 + minute * 60 + second)
+
+
+def parse_games(response) -> List[Game]:
+    if not response:
+        return []
+    license_info = LicenseInfo(LicenseType.SinglePurchase, None)
+    return [
+        Game(game_id=title["titleId"], game_title=title["name"], dlcs=[], license_info=license_info)
+        for title in response["titles"]
+    ]
+
+
+def parse_trophy_titles(response) -> List[TrophyTitle]:
+    if not response:
+        return []
+    return [
+        TrophyTitle(
+            communication_id=title["npCommunicationId"],
+            last_update_time=fast_parse_timestamp((title.get("fromUser") or {})["lastUpdateDate"])
+        )
+        for title in response.get("trophyTitles", [])
+    ]
+
+
+def parse_trophy_groups(response) -> Dict[TrophyGroupId, TrophyGroupState]:
+    if not response:
+        return {}
+    groups = {}
+    for group in response.get("trophyGroups", []):
+        from_user = group.get("fromUser") or {}
+        last_update_date = from_user.get("lastUpdateDate")
+        groups[TrophyGroupId(str(group["trophyGroupId"]))] = TrophyGroupState(
+            progress=int(from_user.get("progress", 0)),
+            earned=sum(int(count) for count in (from_user.get("earnedTrophies") or {}).values()),
+            last_update_time=fast_parse_timestamp(last_update_date) if last_update_date else None
+        )
+    return groups
+
+
+def parse_earned_trophies(response, trophy_group_id: TrophyGroupId) -> Dict[TrophyGroupId, List[TrophyRow]]:
+    groups: Dict[TrophyGroupId, List[TrophyRow]] = {}
+    if trophy_group_id != ALL_TROPHY_GROUPS:
+        groups[trophy_group_id] = []
+    if not response:
+        return groups
+
+    default_group = trophy_group_id if trophy_group_id != ALL_TROPHY_GROUPS else DEFAULT_TROPHY_GROUP
+    for trophy in response.get("trophies", []):
+        from_user = trophy.get("fromUser")
+        if not (from_user and from_user.get("earned")):
+            continue
+        group_id = TrophyGroupId(str(trophy.get("groupId") or default_group))
+        rows = groups.get(group_id)
+        if rows is None:
+            rows = groups[group_id] = []
+        rows.append((
+            str(trophy["trophyId"]),
+            str(trophy["trophyName"]),
+            fast_parse_timestamp(from_user["earnedDate"])
+        ))
+    return groups
+
+
+def parse_friends(response) -> List[FriendInfo]:
+    if not response:
+        return []
+    return [
+        FriendInfo(user_id=str(profile["accountId"]), user_name=str(profile["onlineId"]))
+        for profile in response.get("profiles", [])
+    ]
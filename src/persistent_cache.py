@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import sys
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from parsers import UnixTimestamp
+
+STORE_VERSION = 3
+STORE_FILE_NAME = "psn_cache_{user_id}.jsonl"
+# on open, the log is rewritten with live records only once superseded records take this share of a file of this size
+COMPACTION_RATIO = 0.5
+COMPACTION_MIN_SIZE = 256 * 1024
+
+_HEADER = {"version": STORE_VERSION}
+
+
+def default_cache_dir() -> str:
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Application Support")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(base, "GOG.com", "Galaxy", "plugins", "data", "psn")
+
+
+def _dumps(data) -> bytes:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def _dump_record(namespace: str, key: Any, timestamp: UnixTimestamp, value: Any) -> bytes:
+    # compact JSON has no raw tabs, the first one ends the prefix
+    prefix = json.dumps([namespace, key, timestamp], separators=(",", ":"), ensure_ascii=False)
+    return (prefix + "\t").encode("utf-8") + _dumps(value)
+
+
+# Append-only record log: a version header followed by one `[namespace, key, timestamp]<TAB>value` line per update.
+# Only record locations are kept in memory, the index is built from the prefixes and values are read back from disk
+# on demand. Updates are only ever appended; superseded records are dropped when the file is opened, by rewriting the
+# log once they take up most of it.
+class PersistentStore:
+    def __init__(self, path: str):
+        self._path = path
+        self._file = None
+        self._disabled = False
+        # (namespace, key) -> (offset, length, timestamp)
+        self._index: Dict[Tuple[str, Any], Tuple[int, int, UnixTimestamp]] = {}
+        self._size = 0
+        self._dead = 0  # bytes taken by superseded records
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _open(self):
+        if self._disabled:
+            return None
+        if self._file is not None:
+            return self._file
+
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        self._file = open(self._path, "a+b")
+        self._file.seek(0)
+        header = self._file.readline()
+        try:
+            valid = json.loads(header.decode("utf-8")) == _HEADER
+        except ValueError:
+            valid = False
+
+        if not valid:
+            if header:
+                logging.info("Discarding incompatible cache file %s", self._path)
+            self._file.truncate(0)
+            self._file.write(_dumps(_HEADER))
+            self._file.flush()
+            self._size = self._file.tell()
+            return self._file
+
+        self._load_index()
+        self._maybe_compact()
+        return self._file
+
+    def _load_index(self):
+        offset = self._file.tell()
+        for line in iter(self._file.readline, b""):
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("Incomplete record")
+                namespace, key, timestamp = json.loads(line[:line.index(b"\t")].decode("utf-8"))
+            except (ValueError, TypeError):
+                # torn write from an interrupted session, drop the tail
+                logging.warning("Truncating damaged cache file %s at %d", self._path, offset)
+                self._file.truncate(offset)
+                break
+            self._add(namespace, key, offset, len(line), timestamp)
+            offset += len(line)
+        self._size = offset
+
+    def _add(self, namespace: str, key: Any, offset: int, length: int, timestamp: UnixTimestamp):
+        index_key = (namespace, _hashable(key))
+        superseded = self._index.get(index_key)
+        if superseded is not None:
+            self._dead += superseded[1]
+        self._index[index_key] = (offset, length, timestamp)
+
+    def _maybe_compact(self):
+        if self._size < COMPACTION_MIN_SIZE or self._dead < self._size * COMPACTION_RATIO:
+            return
+        logging.debug("Compacting cache file %s, %d of %d bytes are superseded", self._path, self._dead, self._size)
+        compacted_path = self._path + ".tmp"
+        index = {}
+        with open(compacted_path, "wb") as compacted:
+            compacted.write(_dumps(_HEADER))
+            # live records are copied as they are, in their original order
+            for index_key, (offset, length, timestamp) in sorted(self._index.items(), key=lambda item: item[1][0]):
+                self._file.seek(offset)
+                index[index_key] = (compacted.tell(), length, timestamp)
+                compacted.write(self._file.read(length))
+            size = compacted.tell()
+        self._file.close()
+        self._file = None
+        os.replace(compacted_path, self._path)
+        self._file = open(self._path, "a+b")
+        self._index = index
+        self._size = size
+        self._dead = 0
+
+    def _disable(self):
+        logging.exception("Persistent cache %s is not available", self._path)
+        self.close()
+        self._disabled = True
+
+    def get(self, namespace: str, key: Any) -> Optional[Tuple[Any, UnixTimestamp]]:
+        try:
+            file = self._open()
+            if file is None:
+                return None
+            location = self._index.get((namespace, _hashable(key)))
+            if location is None:
+                return None
+            offset, length, timestamp = location
+            file.seek(offset)
+            line = file.read(length)
+            return json.loads(line[line.index(b"\t") + 1:].decode("utf-8")), timestamp
+        except (OSError, ValueError):
+            self._disable()
+            return None
+
+    def timestamps(self, namespace: str) -> Dict[Any, UnixTimestamp]:
+        try:
+            if self._open() is None:
+                return {}
+        except OSError:
+            self._disable()
+            return {}
+        return {
+            key: timestamp
+            for (record_namespace, key), (_, _, timestamp) in self._index.items()
+            if record_namespace == namespace
+        }
+
+    def put(self, namespace: str, key: Any, value: Any, timestamp: UnixTimestamp):
+        try:
+            file = self._open()
+            if file is None:
+                return
+            record = _dump_record(namespace, key, timestamp, value)
+            file.seek(0, os.SEEK_END)
+            offset = file.tell()
+            file.write(record)
+            file.flush()
+            self._add(namespace, key, offset, len(record), timestamp)
+            self._size = offset + len(record)
+        except (OSError, ValueError, TypeError):
+            self._disable()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._index.clear()
+        self._size = self._dead = 0
+
+
+def _hashable(key):
+    return tuple(key) if isinstance(key, list) else key
+
+
+class StoreNamespace:
+    def __init__(
+        self,
+        store: PersistentStore,
+        name: str,
+        encode: Callable[[Any], Any] = lambda value: value,
+        decode: Callable[[Any], Any] = lambda value: value
+    ):
+        self._store = store
+        self._name = name
+        self._encode = encode
+        self._decode = decode
+
+    def get(self, key: Any) -> Optional[Tuple[Any, UnixTimestamp]]:
+        record = self._store.get(self._name, key)
+        if record is None:
+            return None
+        value, timestamp = record
+        return self._decode(value), timestamp
+
+    def timestamps(self) -> Dict[Any, UnixTimestamp]:
+        return self._store.timestamps(self._name)
+
+    def put(self, key: Any, value: Any, timestamp: UnixTimestamp):
+        self._store.put(self._name, key, self._encode(value), timestamp)
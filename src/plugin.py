@@ -1,57 +1,180 @@
 import asyncio
 import logging
+import os
 import sys
+import time
 
 from galaxy.api.plugin import Plugin, create_and_run_plugin
-from galaxy.api.types import Authentication, NextStep, Achievement
+from galaxy.api.types import Authentication, FriendInfo, Game, NextStep
 from galaxy.api.consts import Platform
 from galaxy.api.jsonrpc import InvalidParams
 from galaxy.api.errors import ApplicationError, InvalidCredentials, UnknownError, AuthenticationRequired
 from cache import Cache
-from http_client import AuthenticatedHttpClient
-from psn_client import (
-    CommunicationId, TitleId,
-    PSNClient, MAX_TITLE_IDS_PER_REQUEST, COMM_ID_NOT_AVAILABLE
-)
-from typing import Dict, List, Set, Iterable
+from friends import FriendsIndex, decode_friends, encode_friends
+from import_scheduler import ImportScheduler
+from metrics import METRICS, LoopLagProbe
+from owned_games import OwnedGamesIndex
+from parsers import COMM_ID_NOT_AVAILABLE, CommunicationId, TitleId, UnixTimestamp
+from persistent_cache import PersistentStore, StoreNamespace, STORE_FILE_NAME, default_cache_dir
+from trophies import GameTrophies, decode_game_trophies, encode_game_trophies, fetch_game_trophies
+from trophy_titles import TrophyTitleIndex
+from typing import Dict, List, Optional, Set, Iterable, Tuple
 from version import __version__
 
-from http_client import OAUTH_LOGIN_URL, OAUTH_LOGIN_REDIRECT_URL
+# aiohttp and the modules built on it are imported on first use, see PSNPlugin._create_clients
 
-AUTH_PARAMS = {
-    "window_title": "Login to My PlayStation\u2122",
-    "window_width": 536,
-    "window_height": 675,
-    "start_uri": OAUTH_LOGIN_URL,
-    "end_uri_regex": "^" + OAUTH_LOGIN_REDIRECT_URL + ".*"
-}
+
+def auth_params():
+    from http_client import OAUTH_LOGIN_URL, OAUTH_LOGIN_REDIRECT_URL
+
+    return {
+        "window_title": "Login to My PlayStation\u2122",
+        "window_width": 536,
+        "window_height": 675,
+        "start_uri": OAUTH_LOGIN_URL,
+        "end_uri_regex": "^" + OAUTH_LOGIN_REDIRECT_URL + ".*"
+    }
+
+
+class Deferred:
+    # instance attribute set by _create_clients(), which runs on the first access of any of them
+    def __set_name__(self, owner, name):
+        self._name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        instance._create_clients()
+        return instance.__dict__[self._name]
+
+
+# in-memory budgets, evicted entries are still served from the on-disk store
+COMM_IDS_CACHE_SIZE = 2 * 1024 * 1024
+TROPHIES_CACHE_SIZE = 32 * 1024 * 1024
+
+# trophies of this many most recently updated titles are prefetched right after login
+WARM_UP_TROPHY_TITLES = 50
+WARM_UP_ENABLED = True
+# open connections to the hosts used after login while the profile request is answered
+PREWARM_CONNECTIONS = True
+
+FRIENDS_SYNC_INTERVAL = 5 * 60  # seconds
+OWNED_GAMES_SYNC_INTERVAL = 5 * 60
+METRICS_INTERVAL = 60  # seconds
+METRICS_FILE_NAME = "psn_metrics.json"
 
 
 class PSNPlugin(Plugin):
+    _http_client = Deferred()
+    _psn_client = Deferred()
+    _comm_ids_batcher = Deferred()
+    _trophy_titles = Deferred()
+    _friends = Deferred()
+    _games_index = Deferred()
+
     def __init__(self, reader, writer, token):
         super().__init__(Platform.Psn, __version__, reader, writer, token)
-        self._http_client = AuthenticatedHttpClient(self.lost_authentication)
-        self._psn_client = PSNClient(self._http_client)
-        self._comm_ids_cache: Dict[TitleId, CommunicationId] = {}
-        self._trophies_cache = Cache()
+        self._comm_ids_cache = Cache(max_size=COMM_IDS_CACHE_SIZE)
+        self._trophies_cache = Cache(max_size=TROPHIES_CACHE_SIZE)
+        # Galaxy is told about changes only once it has the list
+        self._friends_listed = False
+        self._friends_sync_task: Optional[asyncio.Future] = None
+        self._friends_synced_at = time.time()
+        self._store: Optional[PersistentStore] = None
+        # in-flight work shared between the warm-up and Galaxy's own calls
+        self._owned_games_task: Optional[asyncio.Future] = None
+        self._games_listed = False
+        self._games_sync_task: Optional[asyncio.Future] = None
+        self._games_synced_at = time.time()
+        self._trophy_fetches: Dict[CommunicationId, asyncio.Future] = {}
+        self._warm_up_task: Optional[asyncio.Future] = None
+        self._prewarm_task: Optional[asyncio.Future] = None
+        # most recently updated games are imported first
+        self._import_scheduler: ImportScheduler[Tuple[TitleId, CommunicationId, UnixTimestamp]] = ImportScheduler(
+            lambda job: self._import_game_achievements(*job)
+        )
+        self._loop_lag_probe = LoopLagProbe(METRICS.loop_lag)
+        self._metrics_reported_at = time.time()
+        METRICS.register_cache("comm_ids", self._comm_ids_cache.stats)
+        METRICS.register_cache("trophies", self._trophies_cache.stats)
         logging.getLogger("urllib3").setLevel(logging.FATAL)
 
+    @property
+    def _clients_created(self) -> bool:
+        return "_http_client" in self.__dict__
+
+    def _create_clients(self):
+        # deferred until the first request so the process answers Galaxy's handshake without loading aiohttp
+        if self._clients_created:
+            return
+        from batcher import MicroBatcher
+        from http_client import AuthenticatedHttpClient
+        from psn_client import MAX_TITLE_IDS_PER_REQUEST, PSNClient
+
+        self._http_client = AuthenticatedHttpClient(self._auth_lost)
+        self._psn_client = PSNClient(self._http_client)
+        # lookups from concurrent callers share full GAME_DETAILS_URL requests
+        self._comm_ids_batcher: MicroBatcher[TitleId, CommunicationId] = MicroBatcher(
+            self._fetch_communication_ids, MAX_TITLE_IDS_PER_REQUEST
+        )
+        self._trophy_titles = TrophyTitleIndex(self._psn_client)
+        self._friends = FriendsIndex(self._psn_client)
+        self._friends.listen(self._on_friends_changed)
+        self._games_index = OwnedGamesIndex(self._psn_client, self._filter_games)
+        METRICS.register_cache("responses", self._http_client.response_cache)
+
+    def _attach_store(self, user_id):
+        if self._store is not None:
+            self._store.close()
+        # opened lazily on first cache access
+        self._store = PersistentStore(os.path.join(default_cache_dir(), STORE_FILE_NAME.format(user_id=user_id)))
+        self._comm_ids_cache.attach(StoreNamespace(self._store, "comm_ids"))
+        self._trophies_cache.attach(
+            StoreNamespace(self._store, "trophies", encode_game_trophies, decode_game_trophies)
+        )
+        self._trophy_titles.attach(StoreNamespace(self._store, "trophy_titles"))
+        self._friends.attach(StoreNamespace(self._store, "friends", encode_friends, decode_friends))
+
+    def _auth_lost(self):
+        self._cancel_background_work()
+        self.lost_authentication()
+
+    def _cancel_background_work(self):
+        for task in (self._warm_up_task, self._prewarm_task):
+            if task is not None:
+                task.cancel()
+        self._import_scheduler.cancel()
+        for task in (self._friends_sync_task, self._games_sync_task):
+            if task is not None:
+                task.cancel()
+        for task in list(self._trophy_fetches.values()):
+            task.cancel()
+
     async def _do_auth(self, npsso):
         if not npsso:
             raise InvalidCredentials()
 
         try:
             await self._http_client.authenticate(npsso)
+            if PREWARM_CONNECTIONS:
+                import psn_client
+                self._prewarm_task = asyncio.ensure_future(self._http_client.prewarm([
+                    psn_client.GAME_LIST_URL, psn_client.TROPHY_TITLES_URL, psn_client.FRIENDS_URL
+                ]))
             user_id, user_name = await self._psn_client.async_get_own_user_info()
         except Exception:
             raise InvalidCredentials()
 
+        self._attach_store(user_id)
+        self._loop_lag_probe.start()
+        if WARM_UP_ENABLED:
+            self._start_warm_up()
         return Authentication(user_id=user_id, user_name=user_name)
 
     async def authenticate(self, stored_credentials=None):
         stored_npsso = stored_credentials.get("npsso") if stored_credentials else None
         if not stored_npsso:
-            return NextStep("web_session", AUTH_PARAMS)
+            return NextStep("web_session", auth_params())
 
         return await self._do_auth(stored_npsso)
 
@@ -70,19 +193,16 @@ class PSNPlugin(Plugin):
     def _is_game(comm_id: CommunicationId) -> bool:
         return comm_id != COMM_ID_NOT_AVAILABLE
 
-    async def update_communication_id_cache(self, title_ids: List[TitleId]) -> Dict[TitleId, CommunicationId]:
-        async def updater(title_id_slice: Iterable[TitleId]):
-            delta.update(await self._psn_client.async_get_game_communication_id_map(title_id_slice))
-
-        delta: Dict[TitleId, CommunicationId] = dict()
-        await asyncio.gather(*[
-            updater(title_ids[it:it + MAX_TITLE_IDS_PER_REQUEST])
-            for it in range(0, len(title_ids), MAX_TITLE_IDS_PER_REQUEST)
-        ])
-
-        self._comm_ids_cache.update(delta)
+    async def _fetch_communication_ids(self, title_ids: List[TitleId]) -> Dict[TitleId, CommunicationId]:
+        delta = await self._psn_client.async_get_game_communication_id_map(title_ids)
+        for title_id, comm_id in delta.items():
+            # a title is also reported as not a game when the response could not be parsed, that is not kept on disk
+            self._comm_ids_cache.update(title_id, comm_id, persist=self._is_game(comm_id))
         return delta
 
+    async def update_communication_id_cache(self, title_ids: List[TitleId]) -> Dict[TitleId, CommunicationId]:
+        return await self._comm_ids_batcher.get(title_ids)
+
     async def get_game_communication_ids(self, title_ids: List[TitleId]) -> Dict[TitleId, CommunicationId]:
         result: Dict[TitleId, CommunicationId] = dict()
         misses: Set[TitleId] = set()
@@ -98,14 +218,56 @@ class PSNPlugin(Plugin):
 
         return result
 
-    async def get_owned_games(self):
-        async def filter_games(titles):
-            comm_id_map = await self.get_game_communication_ids([t.game_id for t in titles])
-            return [title for title in titles if self._is_game(comm_id_map[title.game_id])]
+    def _start_warm_up(self):
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+        self._warm_up_task = asyncio.ensure_future(self._warm_up())
+
+    async def _warm_up(self):
+        # Galaxy asks for owned games and then achievements right after login, start both fan-outs now;
+        # trophies wait for the owned games so they do not queue up ahead of comm-ID lookups on the same host
+        owned_games = self._owned_games()
+        trophy_titles = asyncio.ensure_future(self._trophy_titles.sync())
+        results = list(await asyncio.gather(asyncio.shield(owned_games), trophy_titles, return_exceptions=True))
+
+        if not isinstance(results[1], Exception):
+            fetches = []
+            for title in sorted(results[1].values(), key=lambda t: t.last_update_time, reverse=True):
+                if len(fetches) == WARM_UP_TROPHY_TITLES:
+                    break
+                if self._trophies_cache.get(title.communication_id, title.last_update_time) is None:
+                    fetches.append(self._fetch_trophies(title.communication_id, title.last_update_time))
+            results.extend(await asyncio.gather(*fetches, return_exceptions=True))
+
+        failures = [result for result in results if isinstance(result, Exception)]
+        if failures:
+            logging.info("Warm-up finished with %d failures, first: %r", len(failures), failures[0])
+
+    async def _filter_games(self, titles: List[Game]) -> List[Game]:
+        comm_id_map = await self.get_game_communication_ids([t.game_id for t in titles])
+        return [title for title in titles if self._is_game(comm_id_map[title.game_id])]
+
+    async def _fetch_owned_games(self) -> List[Game]:
+        await self._games_index.sync(full=True)
+        return self._games_index.games
+
+    def _owned_games(self) -> asyncio.Future:
+        task = self._owned_games_task
+        if task is None or task.cancelled() or (task.done() and task.exception() is not None):
+            task = self._owned_games_task = asyncio.ensure_future(self._fetch_owned_games())
+        return task
 
-        return await filter_games(
-            await self._psn_client.async_get_owned_games()
-        )
+    async def get_owned_games(self):
+        task = self._owned_games()
+        try:
+            games = await asyncio.shield(task)
+            self._games_listed = True
+            self._games_synced_at = time.time()
+            return games
+        finally:
+            # a finished result (e.g. from the warm-up) is handed out once, later calls fetch again
+            if self._owned_games_task is task and task.done():
+                self._owned_games_task = None
 
     # TODO: backward compatibility. remove when GLX handles batch imports
     async def get_unlocked_achievements(self, game_id: TitleId):
@@ -126,48 +288,144 @@ class PSNPlugin(Plugin):
         await super().start_achievements_import(game_ids)
 
     async def import_games_achievements(self, game_ids: Iterable[TitleId]):
+        with METRICS.stage("import.total"):
+            await self._import_games_achievements(game_ids)
+
+    async def _import_games_achievements(self, game_ids: Iterable[TitleId]):
+        # every chunk of games goes on as soon as its comm IDs are resolved, trophy titles are streamed meanwhile
+        game_ids = list(game_ids)
+        chunk_size = self._comm_ids_batcher.batch_size
+        self._trophy_titles.start_sync()
+        await asyncio.gather(*[
+            self._import_games_chunk(game_ids[start:start + chunk_size])
+            for start in range(0, len(game_ids), chunk_size)
+        ])
+
+    async def _import_games_chunk(self, game_ids: List[TitleId]):
         try:
-            comm_ids = await self.get_game_communication_ids(game_ids)
-            trophy_titles = await self._psn_client.get_trophy_titles()
+            with METRICS.stage("import.comm_ids"):
+                comm_ids = await self.get_game_communication_ids(game_ids)
         except ApplicationError as error:
             for game_id in game_ids:
                 self.game_achievements_import_failure(game_id, error)
+            return
 
-        # make a map
-        trophy_titles = {trophy_title.communication_id: trophy_title for trophy_title in trophy_titles}
-        requests = []
+        jobs = []
         for game_id, comm_id in comm_ids.items():
             if not self._is_game(comm_id):
                 self.game_achievements_import_failure(game_id, InvalidParams())
                 continue
-            trophy_title = trophy_titles.get(comm_id)
+            try:
+                trophy_title = await self._trophy_titles.get(comm_id)
+            except ApplicationError as error:
+                self.game_achievements_import_failure(game_id, error)
+                continue
             if trophy_title is None:
                 self.game_achievements_import_success(game_id, [])
                 continue
-            trophies = self._trophies_cache.get(comm_id, trophy_title.last_update_time)
+            trophies: Optional[GameTrophies] = self._trophies_cache.get(comm_id, trophy_title.last_update_time)
             if trophies is not None:
-                self.game_achievements_import_success(game_id, trophies)
+                self.game_achievements_import_success(game_id, trophies.achievements)
                 continue
-            requests.append(self._import_game_achievements(game_id, comm_id))
-        await asyncio.gather(*requests)
-
-    async def _import_game_achievements(self, title_id: TitleId, comm_id: CommunicationId):
+            timestamp = trophy_title.last_update_time
+            jobs.append((-timestamp, (game_id, comm_id, timestamp)))
+        if not jobs:
+            return
+        # the jobs join those of the other chunks in the scheduler's queue, most recently updated games go first
+        with METRICS.stage("import.trophies"):
+            cancelled = await self._import_scheduler.run(jobs)
+        for game_id, _, _ in cancelled:
+            error = UnknownError() if self._http_client.is_authenticated else AuthenticationRequired()
+            self.game_achievements_import_failure(game_id, error)
+
+    async def _import_game_achievements(
+        self,
+        title_id: TitleId,
+        comm_id: CommunicationId,
+        timestamp: UnixTimestamp
+    ):
         try:
-            trophies: List[Achievement] = await self._psn_client.async_get_earned_trophies(comm_id)
-            timestamp = max(trophy.unlock_time for trophy in trophies)
-            self._trophies_cache.update(comm_id, trophies, timestamp)
-            self.game_achievements_import_success(title_id, trophies)
+            trophies = await asyncio.shield(self._fetch_trophies(comm_id, timestamp))
+            self.game_achievements_import_success(title_id, trophies.achievements)
         except ApplicationError as error:
             self.game_achievements_import_failure(title_id, error)
         except Exception:
             logging.exception("Unhandled exception. Please report it to the plugin developers")
             self.game_achievements_import_failure(title_id, UnknownError())
 
+    def _fetch_trophies(self, comm_id: CommunicationId, timestamp: UnixTimestamp) -> asyncio.Future:
+        task = self._trophy_fetches.get(comm_id)
+        if task is None:
+            task = self._trophy_fetches[comm_id] = asyncio.ensure_future(self._do_fetch_trophies(comm_id, timestamp))
+            task.add_done_callback(
+                lambda done: self._trophy_fetches.pop(comm_id) if self._trophy_fetches.get(comm_id) is done else None
+            )
+        return task
+
+    async def _do_fetch_trophies(self, comm_id: CommunicationId, timestamp: UnixTimestamp) -> GameTrophies:
+        # only trophy groups that changed since the cached state are downloaded again
+        trophies = await fetch_game_trophies(self._psn_client, comm_id, self._trophies_cache.peek(comm_id))
+        self._trophies_cache.update(comm_id, trophies, timestamp)
+        return trophies
+
     async def get_friends(self):
-        return await self._psn_client.async_get_friends()
+        friends = await self._friends.get()
+        self._friends_listed = True
+        self._friends_synced_at = time.time()
+        return friends
+
+    def _on_friends_changed(self, added: List[FriendInfo], removed: List[str]):
+        if not self._friends_listed:
+            return
+        for friend in added:
+            self.add_friend(friend)
+        for user_id in removed:
+            self.remove_friend(user_id)
+
+    async def _sync_friends(self):
+        try:
+            await self._friends.sync()
+        except ApplicationError as error:
+            logging.info("Friends sync failed: %r", error)
+
+    async def _sync_owned_games(self):
+        try:
+            added, removed = await self._games_index.sync()
+        except ApplicationError as error:
+            logging.info("Owned games sync failed: %r", error)
+            return
+        for game in added:
+            self.add_game(game)
+        for game_id in removed:
+            self.remove_game(game_id)
+
+    def tick(self):
+        now = time.time()
+        if self._games_listed and self._http_client.is_authenticated \
+                and now - self._games_synced_at >= OWNED_GAMES_SYNC_INTERVAL:
+            self._games_synced_at = now
+            if self._games_sync_task is None or self._games_sync_task.done():
+                self._games_sync_task = asyncio.ensure_future(self._sync_owned_games())
+
+        if self._friends_listed and self._http_client.is_authenticated \
+                and now - self._friends_synced_at >= FRIENDS_SYNC_INTERVAL:
+            self._friends_synced_at = now
+            if self._friends_sync_task is None or self._friends_sync_task.done():
+                self._friends_sync_task = asyncio.ensure_future(self._sync_friends())
+
+        if now - self._metrics_reported_at >= METRICS_INTERVAL:
+            self._metrics_reported_at = now
+            METRICS.log()
+            METRICS.dump(os.path.join(default_cache_dir(), METRICS_FILE_NAME))
 
     def shutdown(self):
-        asyncio.create_task(self._http_client.logout())
+        self._loop_lag_probe.stop()
+        self._cancel_background_work()
+        if self._store is not None:
+            self._store.close()
+        if self._clients_created:
+            self._comm_ids_batcher.cancel()
+            asyncio.create_task(self._http_client.logout())
 
 
 def main():
@@ -1,14 +1,17 @@
 import asyncio
 import logging
-from dataclasses import dataclass
-from datetime import datetime, timezone
-from functools import partial
-from typing import Dict, List, NewType
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Tuple
 
+import aiohttp
 from galaxy.api.errors import UnknownBackendResponse
-from galaxy.api.types import Achievement, Game, LicenseInfo, FriendInfo
-from galaxy.api.consts import LicenseType
-from http_client import paginate_url
+from galaxy.api.types import Achievement, Game, FriendInfo
+from http_client import paginate_url, run_in_executor
+from parsers import (
+    ALL_TROPHY_GROUPS, COMM_ID_NOT_AVAILABLE, CommunicationId, TitleId, TrophyGroupId, TrophyGroupState, TrophyRow,
+    TrophyTitle, parse_earned_trophies, parse_friends, parse_games, parse_trophy_groups, parse_trophy_titles
+)
+from retry import RequestPolicy, RetryBudget, with_retry
 
 # game_id_list is limited to 5 IDs per request
 GAME_DETAILS_URL = "https://pl-tpy.np.community.playstation.net/trophy/v1/apps/trophyTitles" \
@@ -32,6 +35,11 @@ EARNED_TROPHIES_PAGE = "https://pl-tpy.np.community.playstation.net/trophy/v1/"
     "&visibleType=1" \
     "&npLanguage=en"
 
+TROPHY_GROUPS_URL = "https://pl-tpy.np.community.playstation.net/trophy/v1/" \
+    "trophyTitles/{communication_id}/trophyGroups?" \
+    "fields=@default" \
+    "&npLanguage=en"
+
 USER_INFO_URL = "https://pl-prof.np.community.playstation.net/userProfile/v1/users/{user_id}/profile2" \
     "?fields=accountId,onlineId"
 
@@ -39,72 +47,119 @@ FRIENDS_URL = "https://us-prof.np.community.playstation.net/userProfile/v1/users
     "?fields=accountId,onlineId"
 
 DEFAULT_LIMIT = 100
+# pages requested ahead of the one being consumed
+DEFAULT_PREFETCH = 8
 MAX_TITLE_IDS_PER_REQUEST = 5
-COMM_ID_NOT_AVAILABLE = "-N/A-"
-
-CommunicationId = NewType("CommunicationId", str)
-TitleId = NewType("TitleId", str)
-UnixTimestamp = NewType("UnixTimestamp", int)
-
 
-def parse_timestamp(earned_date) -> UnixTimestamp:
-    dt = datetime.strptime(earned_date, "%Y-%m-%dT%H:%M:%SZ")
-    dt = datetime.combine(dt.date(), dt.time(), timezone.utc)
-    return UnixTimestamp(dt.timestamp())
-
-
-@dataclass
-class TrophyTitle:
-    communication_id: CommunicationId
-    last_update_time: UnixTimestamp
+# timeouts are per attempt and replace the session wide DEFAULT_TIMEOUT
+PROFILE_POLICY = RequestPolicy(timeout=10)
+PAGE_POLICY = RequestPolicy(timeout=20)
+COMM_IDS_POLICY = RequestPolicy(timeout=10)
+# trophy requests hold up a game's import, a slow one is raced by a duplicate
+TROPHIES_POLICY = RequestPolicy(timeout=15, hedge_quantile=0.95)
 
 
 class PSNClient:
     def __init__(self, http_client):
         self._http_client = http_client
+        self._retry_budget = RetryBudget()
 
     @staticmethod
     async def _async(method, *args, **kwargs):
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, partial(method, *args, **kwargs))
+        return await run_in_executor(method, *args, **kwargs)
 
-    async def fetch_paginated_data(
+    @staticmethod
+    def _parse_page(parser, response):
+        try:
+            return parser(response)
+        except Exception:
+            logging.exception("Cannot parse data")
+            raise UnknownBackendResponse()
+
+    async def _get(self, url, policy: RequestPolicy, *args, **kwargs):
+        timeout = aiohttp.ClientTimeout(total=policy.timeout)
+        return await with_retry(
+            url,
+            lambda: self._http_client.get(url, *args, timeout=timeout, **kwargs),
+            policy,
+            self._retry_budget
+        )
+
+    async def iterate_paginated_data(
         self,
         parser,
         url,
         counter_name,
         limit=DEFAULT_LIMIT,
+        prefetch=DEFAULT_PREFETCH,
+        policy=PAGE_POLICY,
         *args,
         **kwargs
-    ):
-        response = await self._http_client.get(paginate_url(url=url, limit=limit), *args, **kwargs)
+    ) -> AsyncIterator:
+        def fetch_page(offset):
+            return asyncio.ensure_future(
+                self._get(paginate_url(url=url, limit=limit, offset=offset), policy, *args, **kwargs)
+            )
+
+        def fill():
+            while len(pending) < prefetch:
+                offset = next(offsets, None)
+                if offset is None:
+                    return
+                pending.append(fetch_page(offset))
+
+        response = await self._get(paginate_url(url=url, limit=limit), policy, *args, **kwargs)
         if not response:
-            return []
+            return
 
         try:
             total = int(response.get(counter_name, 0))
         except ValueError:
             raise UnknownBackendResponse()
 
-        responses = [response] + await asyncio.gather(*[
-            self._http_client.get(paginate_url(url=url, limit=limit, offset=offset), *args, **kwargs)
-            for offset in range(limit, total, limit)
-        ])
-
+        offsets = iter(range(limit, total, limit))
+        pending: Deque[asyncio.Future] = deque()
         try:
-            return [rec for res in responses for rec in parser(res)]
-        except Exception:
-            logging.exception("Cannot parse data")
-            raise UnknownBackendResponse()
+            fill()
+            records = self._parse_page(parser, response)
+            del response
+            for record in records:
+                yield record
+
+            while True:
+                if not pending:
+                    offset = next(offsets, None)
+                    if offset is None:
+                        break
+                    pending.append(fetch_page(offset))
+                records = self._parse_page(parser, await pending.popleft())
+                fill()
+                for record in records:
+                    yield record
+        finally:
+            for page in pending:
+                page.cancel()
 
-    async def fetch_data(self, parser, *args, **kwargs):
-        response = await self._http_client.get(*args, **kwargs)
+    async def fetch_paginated_data(
+        self,
+        parser,
+        url,
+        counter_name,
+        limit=DEFAULT_LIMIT,
+        prefetch=DEFAULT_PREFETCH,
+        policy=PAGE_POLICY,
+        *args,
+        **kwargs
+    ):
+        return [
+            record async for record in self.iterate_paginated_data(
+                parser, url, counter_name, limit, prefetch, policy, *args, **kwargs
+            )
+        ]
 
-        try:
-            return parser(response)
-        except Exception:
-            logging.exception("Cannot parse data")
-            raise UnknownBackendResponse()
+    async def fetch_data(self, parser, url, policy=PAGE_POLICY, *args, **kwargs):
+        response = await self._get(url, policy, *args, **kwargs)
+        return self._parse_page(parser, response)
 
     async def async_get_own_user_info(self):
         def user_info_parser(response):
@@ -112,27 +167,28 @@ class PSNClient:
 
         return await self.fetch_data(
             user_info_parser,
-            USER_INFO_URL.format(user_id="me")
+            USER_INFO_URL.format(user_id="me"),
+            PROFILE_POLICY
         )
 
-    async def async_get_owned_games(self):
-        def game_parser(title):
-            return Game(
-                game_id=title["titleId"],
-                game_title=title["name"],
-                dlcs=[],
-                license_info=LicenseInfo(LicenseType.SinglePurchase, None)
-            )
+    def iter_owned_games(self, prefetch=DEFAULT_PREFETCH) -> AsyncIterator[Game]:
+        return self.iterate_paginated_data(
+            parse_games,
+            GAME_LIST_URL.format(user_id="me"),
+            "totalResults",
+            prefetch=prefetch
+        )
 
-        def games_parser(response):
-            return [
-                game_parser(title) for title in response["titles"]
-            ] if response else []
+    async def async_get_owned_games(self) -> List[Game]:
+        return [game async for game in self.iter_owned_games()]
 
-        return await self.fetch_paginated_data(
-            games_parser,
-            GAME_LIST_URL.format(user_id="me"),
-            "totalResults"
+    async def async_get_owned_games_page(self, offset=0, limit=DEFAULT_LIMIT) -> Tuple[int, List[Game]]:
+        def owned_games_page_parser(response):
+            return int(response.get("totalResults", 0)) if response else 0, parse_games(response)
+
+        return await self.fetch_data(
+            owned_games_page_parser,
+            paginate_url(GAME_LIST_URL.format(user_id="me"), limit=limit, offset=offset)
         )
 
     async def async_get_game_communication_id_map(self, game_ids: List[TitleId]) -> Dict[TitleId, CommunicationId]:
@@ -152,7 +208,8 @@ class PSNClient:
 
         mapping = await self.fetch_data(
             communication_ids_parser,
-            GAME_DETAILS_URL.format(game_id_list=",".join(game_ids))
+            GAME_DETAILS_URL.format(game_id_list=",".join(game_ids)),
+            COMM_IDS_POLICY
         )
 
         return {
@@ -160,22 +217,12 @@ class PSNClient:
             for game_id in game_ids
         }
 
-    async def get_trophy_titles(self) -> List[TrophyTitle]:
-        def title_parser(title) -> TrophyTitle:
-            return TrophyTitle(
-                communication_id=title["npCommunicationId"],
-                last_update_time=parse_timestamp((title.get("fromUser") or {})["lastUpdateDate"])
-            )
-
-        def titles_parser(response) -> List[TrophyTitle]:
-            return [
-                title_parser(title) for title in response.get("trophyTitles", [])
-            ] if response else []
-
-        return await self.fetch_paginated_data(
-            parser=titles_parser,
+    def iter_trophy_titles(self, prefetch=DEFAULT_PREFETCH) -> AsyncIterator[TrophyTitle]:
+        return self.iterate_paginated_data(
+            parser=parse_trophy_titles,
             url=TROPHY_TITLES_URL,
             counter_name="totalResults",
+            prefetch=prefetch,
             params={
                 "fields": "@default",
                 "platform": "PS4",
@@ -183,38 +230,42 @@ class PSNClient:
             }
         )
 
-    async def async_get_earned_trophies(self, communication_id) -> List[Achievement]:
-        def trophy_parser(trophy) -> Achievement:
-            return Achievement(
-                achievement_id=str(trophy["trophyId"]),
-                achievement_name=str(trophy["trophyName"]),
-                unlock_time=parse_timestamp(trophy["fromUser"]["earnedDate"])
-            )
+    async def get_trophy_titles(self) -> List[TrophyTitle]:
+        return [title async for title in self.iter_trophy_titles()]
 
-        def trophies_parser(response) -> List[Achievement]:
-            return [
-                trophy_parser(trophy) for trophy in response.get("trophies", [])
-                if trophy.get("fromUser") and trophy["fromUser"].get("earned")
-            ] if response else []
-
-        return await self.fetch_data(trophies_parser, EARNED_TROPHIES_PAGE.format(
-            communication_id=communication_id,
-            trophy_group_id="all"))
-
-    async def async_get_friends(self):
-        def friend_info_parser(profile):
-            return FriendInfo(
-                user_id=str(profile["accountId"]),
-                user_name=str(profile["onlineId"])
-            )
+    async def async_get_trophy_groups(self, communication_id) -> Dict[TrophyGroupId, TrophyGroupState]:
+        return await self.fetch_data(
+            parse_trophy_groups,
+            TROPHY_GROUPS_URL.format(communication_id=communication_id),
+            TROPHIES_POLICY
+        )
 
-        def friend_list_parser(response):
-            return [
-                friend_info_parser(profile) for profile in response.get("profiles", [])
-            ] if response else []
+    async def async_get_earned_trophies_by_group(
+        self,
+        communication_id,
+        trophy_group_id: TrophyGroupId = ALL_TROPHY_GROUPS
+    ) -> Dict[TrophyGroupId, List[TrophyRow]]:
+        return await self.fetch_data(
+            lambda response: parse_earned_trophies(response, trophy_group_id),
+            EARNED_TROPHIES_PAGE.format(communication_id=communication_id, trophy_group_id=trophy_group_id),
+            TROPHIES_POLICY
+        )
 
-        return await self.fetch_paginated_data(
-            friend_list_parser,
+    async def async_get_earned_trophies(self, communication_id) -> List[Achievement]:
+        groups = await self.async_get_earned_trophies_by_group(communication_id)
+        return [
+            Achievement(achievement_id=achievement_id, achievement_name=achievement_name, unlock_time=unlock_time)
+            for rows in groups.values()
+            for achievement_id, achievement_name, unlock_time in rows
+        ]
+
+    def iter_friends(self, prefetch=DEFAULT_PREFETCH) -> AsyncIterator[FriendInfo]:
+        return self.iterate_paginated_data(
+            parse_friends,
             FRIENDS_URL.format(user_id="me"),
-            "totalResults"
+            "totalResults",
+            prefetch=prefetch
         )
+
+    async def async_get_friends(self) -> List[FriendInfo]:
+        return [friend async for friend in self.iter_friends()]
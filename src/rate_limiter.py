@@ -0,0 +1,215 @@
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Deque, Dict, Optional
+from urllib.parse import urlsplit
+
+
+@dataclass
+class HostPolicy:
+    # requests per second; the rate starts high, is halved whenever the host throttles us and creeps back on success
+    rate: float = 50
+    min_rate: float = 1
+    max_rate: float = 100
+    rate_increase: float = 0.5  # per successful request
+    burst: int = 20
+    initial_concurrency: int = 8
+    min_concurrency: int = 1
+    max_concurrency: int = 20
+    base_backoff: float = 1
+    max_backoff: float = 60
+
+
+DEFAULT_POLICY = HostPolicy()
+HOST_POLICIES: Dict[str, HostPolicy] = {
+    "pl-tpy.np.community.playstation.net": HostPolicy(initial_concurrency=8),
+    "gamelist.api.playstation.com": HostPolicy(rate=25, max_rate=50, burst=10, initial_concurrency=4),
+}
+
+# a request may put a future here, it gets the host limiter once the request holds a slot
+slot_acquired: ContextVar[Optional[asyncio.Future]] = ContextVar("slot_acquired", default=None)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate: float):
+        # tokens earned so far are accounted for at the old rate
+        self._refill()
+        self._rate = rate
+
+    def drain(self):
+        # no burst right after the host told us to slow down
+        self._refill()
+        self._tokens = min(self._tokens, 0.0)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    # takes a token and returns how long the caller has to wait before using it
+    def reserve(self) -> float:
+        self._refill()
+        self._tokens -= 1
+        return 0 if self._tokens >= 0 else -self._tokens / self._rate
+
+
+class HostLimiter:
+    def __init__(self, host: str, policy: HostPolicy):
+        self.host = host
+        self._policy = policy
+        self._bucket = TokenBucket(policy.rate, policy.burst)
+        self._limit = float(policy.initial_concurrency)
+        self._in_flight = 0
+        self._queued = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._paused_until = 0.0
+        self._backoff = policy.base_backoff
+
+    @property
+    def concurrency_limit(self) -> int:
+        return max(self._policy.min_concurrency, int(self._limit))
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queued
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def stats(self) -> Dict:
+        return {
+            "concurrency_limit": self.concurrency_limit,
+            "in_flight": self._in_flight,
+            "queued": self._queued,
+            "rate": round(self._bucket.rate, 2),
+            "paused_for": max(0.0, self._paused_until - time.monotonic())
+        }
+
+    async def acquire(self):
+        self._queued += 1
+        try:
+            # requests already waiting go first, a freed slot is handed to the oldest of them
+            if self._in_flight < self.concurrency_limit and not self._waiters:
+                self._in_flight += 1
+            else:
+                waiter = asyncio.get_event_loop().create_future()
+                self._waiters.append(waiter)
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    if waiter.done() and not waiter.cancelled():
+                        # the slot was already handed over, pass it on
+                        self.release()
+                    elif waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                    raise
+        finally:
+            self._queued -= 1
+
+        try:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause <= 0:
+                    break
+                await asyncio.sleep(pause)
+            delay = self._bucket.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        self._in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._in_flight < self.concurrency_limit and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
+    def on_success(self):
+        # additive increase: roughly one extra slot per window of successful requests
+        self._limit = min(self._policy.max_concurrency, self._limit + 1 / self._limit)
+        if self._bucket.rate < self._policy.max_rate:
+            self._bucket.rate = min(self._policy.max_rate, self._bucket.rate + self._policy.rate_increase)
+        self._backoff = self._policy.base_backoff
+
+    def on_congestion(self):
+        # multiplicative decrease on timeouts and unavailability
+        self._limit = max(self._policy.min_concurrency, self._limit / 2)
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        self.on_congestion()
+        # the request rate is only cut on throttling, timeouts say nothing about the host's quota
+        self._bucket.rate = max(self._policy.min_rate, self._bucket.rate / 2)
+        self._bucket.drain()
+        if retry_after is None:
+            retry_after = self._backoff * (1 + random.random()) / 2
+            self._backoff = min(self._policy.max_backoff, self._backoff * 2)
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+
+class RequestScheduler:
+    def __init__(self, policies: Dict[str, HostPolicy] = None, default_policy: HostPolicy = DEFAULT_POLICY):
+        self._policies = HOST_POLICIES if policies is None else policies
+        self._default_policy = default_policy
+        self._hosts: Dict[str, HostLimiter] = {}
+
+    def limiter(self, url: str) -> HostLimiter:
+        host = urlsplit(url).hostname or ""
+        limiter = self._hosts.get(host)
+        if limiter is None:
+            limiter = self._hosts[host] = HostLimiter(host, self._policies.get(host, self._default_policy))
+        return limiter
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        limiter = self.limiter(url)
+        await limiter.acquire()
+        acquired = slot_acquired.get()
+        if acquired is not None and not acquired.done():
+            acquired.set_result(limiter)
+        try:
+            yield limiter
+        finally:
+            limiter.release()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(limiter.queue_depth for limiter in self._hosts.values())
+
+    def stats(self) -> Dict[str, Dict]:
+        return {host: limiter.stats() for host, limiter in self._hosts.items()}
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from galaxy.api.errors import BackendError, BackendNotAvailable, BackendTimeout, NetworkError
+
+from metrics import METRICS
+from rate_limiter import slot_acquired
+
+T = TypeVar("T")
+
+RETRIABLE_ERRORS = (BackendTimeout, BackendNotAvailable, BackendError, NetworkError)
+
+# a hedge is only sent once the endpoint has this many latency samples
+HEDGE_MIN_SAMPLES = 20
+
+
+@dataclass(frozen=True)
+class RequestPolicy:
+    timeout: float = 30  # seconds, for a single attempt
+    attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 8
+    deadline: float = 60  # seconds for all attempts and the waits between them
+    hedge_quantile: Optional[float] = None  # send a duplicate once the first is slower than this latency quantile
+
+    def backoff(self, retry: int) -> float:
+        # full jitter, so clients failing together do not come back together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+
+class RetryBudget:
+    # retries and hedges are paid from tokens earned by successful requests,
+    # a failing backend gets at most `ratio` extra load instead of `attempts` times the load
+    def __init__(self, ratio: float = 0.1, capacity: float = 10):
+        self._ratio = ratio
+        self._capacity = capacity
+        self._tokens = capacity
+
+    @property
+    def tokens(self) -> float:
+        return self._tokens
+
+    def on_success(self):
+        self._tokens = min(self._capacity, self._tokens + self._ratio)
+
+    def try_spend(self) -> bool:
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+def hedge_delay(url: str, quantile: float) -> Optional[float]:
+    latency = METRICS.endpoint(url).latency
+    if latency.count < HEDGE_MIN_SAMPLES:
+        return None
+    return latency.quantile(quantile)
+
+
+async def hedged(call: Callable[[], Awaitable[T]], delay: Optional[float], budget: RetryBudget) -> T:
+    if delay is None:
+        return await call()
+
+    acquired = asyncio.get_event_loop().create_future()
+    token = slot_acquired.set(acquired)
+    try:
+        first = asyncio.ensure_future(call())
+    finally:
+        slot_acquired.reset(token)
+
+    tasks = {first}
+    try:
+        # latency samples are taken on the wire, the time spent queued in the host limiter does not count
+        await asyncio.wait({first, acquired}, return_when=asyncio.FIRST_COMPLETED)
+        if not first.done():
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # a duplicate would only queue up behind requests already waiting for the host
+            if not done and acquired.result().queue_depth == 0 and budget.try_spend():
+                tasks.add(asyncio.ensure_future(call()))
+        while True:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                tasks.discard(task)
+                # the first answer wins, an error only counts when no other request is left
+                if task.exception() is None or not tasks:
+                    return task.result()
+    finally:
+        acquired.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+async def with_retry(
+    url: str,
+    call: Callable[[], Awaitable[T]],
+    policy: RequestPolicy,
+    budget: RetryBudget
+) -> T:
+    deadline = time.monotonic() + policy.deadline
+    delay = hedge_delay(url, policy.hedge_quantile) if policy.hedge_quantile else None
+    for attempt in range(1, policy.attempts + 1):
+        try:
+            result = await hedged(call, delay, budget)
+        except RETRIABLE_ERRORS as error:
+            backoff = policy.backoff(attempt - 1)
+            if attempt == policy.attempts or time.monotonic() + backoff >= deadline or not budget.try_spend():
+                raise
+            logging.info("Retrying %s in %.2fs after %r", url, backoff, error)
+            await asyncio.sleep(backoff)
+        else:
+            budget.on_success()
+            return result
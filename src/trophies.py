@@ -0,0 +1,153 @@
+import asyncio
+from array import array
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from galaxy.api.types import Achievement
+from parsers import ALL_TROPHY_GROUPS, CommunicationId, TrophyGroupId, TrophyGroupState, TrophyRow
+
+if TYPE_CHECKING:
+    from psn_client import PSNClient
+
+
+# Earned trophies of one group packed into typed arrays, Achievement objects are built only when reported.
+# Trophy names are nearly unique, they are kept joined in one string with the end offset of each name.
+class CompactTrophies:
+    __slots__ = ("ids", "names", "name_ends", "unlock_times")
+
+    def __init__(self, ids: array, names: str, name_ends: array, unlock_times: array):
+        self.ids = ids
+        self.names = names
+        self.name_ends = name_ends
+        self.unlock_times = unlock_times
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[Any, str, int]]) -> "CompactTrophies":
+        ids, names, name_ends, unlock_times = array("I"), [], array("I"), array("q")
+        end = 0
+        for achievement_id, achievement_name, unlock_time in rows:
+            ids.append(int(achievement_id))
+            names.append(achievement_name)
+            end += len(achievement_name)
+            name_ends.append(end)
+            unlock_times.append(unlock_time)
+        return cls(ids, "".join(names), name_ends, unlock_times)
+
+    @classmethod
+    def from_achievements(cls, achievements: Iterable[Achievement]) -> "CompactTrophies":
+        return cls.from_rows((a.achievement_id, a.achievement_name, a.unlock_time) for a in achievements)
+
+    def rows(self) -> Iterator[Tuple[str, str, int]]:
+        start = 0
+        for achievement_id, end, unlock_time in zip(self.ids, self.name_ends, self.unlock_times):
+            yield str(achievement_id), self.names[start:end], unlock_time
+            start = end
+
+    def to_achievements(self) -> List[Achievement]:
+        return [
+            Achievement(achievement_id=achievement_id, achievement_name=achievement_name, unlock_time=unlock_time)
+            for achievement_id, achievement_name, unlock_time in self.rows()
+        ]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __eq__(self, other):
+        return isinstance(other, CompactTrophies) and \
+            (self.ids, self.names, self.name_ends, self.unlock_times) == \
+            (other.ids, other.names, other.name_ends, other.unlock_times)
+
+
+@dataclass
+class TrophyGroup:
+    __slots__ = ("state", "trophies")
+    state: Optional[TrophyGroupState]
+    trophies: CompactTrophies
+
+
+@dataclass
+class GameTrophies:
+    __slots__ = ("groups",)
+    groups: Dict[TrophyGroupId, TrophyGroup]
+
+    @property
+    def achievements(self) -> List[Achievement]:
+        return [achievement for group in self.groups.values() for achievement in group.trophies.to_achievements()]
+
+
+def encode_game_trophies(trophies: GameTrophies):
+    return {
+        group_id: [
+            [group.state.progress, group.state.earned, group.state.last_update_time] if group.state else None,
+            list(map(list, group.trophies.rows()))
+        ]
+        for group_id, group in trophies.groups.items()
+    }
+
+
+def decode_game_trophies(data) -> GameTrophies:
+    return GameTrophies({
+        TrophyGroupId(group_id): TrophyGroup(
+            TrophyGroupState(*state) if state else None,
+            CompactTrophies.from_rows(achievements)
+        )
+        for group_id, (state, achievements) in data.items()
+    })
+
+
+def _build_groups(
+    states: Dict[TrophyGroupId, TrophyGroupState],
+    earned: Dict[TrophyGroupId, List[TrophyRow]]
+) -> GameTrophies:
+    earned = dict(earned)
+    groups = {
+        group_id: TrophyGroup(state, CompactTrophies.from_rows(earned.pop(group_id, [])))
+        for group_id, state in states.items()
+    }
+    # trophies of groups missing from the group list, never reused without refetching
+    groups.update({
+        group_id: TrophyGroup(None, CompactTrophies.from_rows(rows))
+        for group_id, rows in earned.items()
+    })
+    return GameTrophies(groups)
+
+
+async def fetch_game_trophies(
+    psn_client: "PSNClient",
+    communication_id: CommunicationId,
+    cached: Optional[GameTrophies] = None
+) -> GameTrophies:
+    if cached is None or len(cached.groups) <= 1:
+        # first import, or a single group where refetching everything is just as cheap: one request,
+        # group states are only needed once the title changes again
+        earned = await psn_client.async_get_earned_trophies_by_group(communication_id, ALL_TROPHY_GROUPS)
+        return _build_groups({}, earned)
+
+    if any(group.state is None for group in cached.groups.values()):
+        # the group states come along so the next change can refetch only the changed group
+        states, earned = await asyncio.gather(
+            psn_client.async_get_trophy_groups(communication_id),
+            psn_client.async_get_earned_trophies_by_group(communication_id, ALL_TROPHY_GROUPS)
+        )
+        return _build_groups(states, earned)
+
+    states = await psn_client.async_get_trophy_groups(communication_id)
+    changed = [
+        group_id for group_id, state in states.items()
+        if group_id not in cached.groups or cached.groups[group_id].state != state
+    ]
+    if len(changed) > 1:
+        # one request for everything is cheaper than one per changed group
+        earned = await psn_client.async_get_earned_trophies_by_group(communication_id, ALL_TROPHY_GROUPS)
+        return _build_groups(states, earned)
+
+    groups = {
+        group_id: cached.groups[group_id]
+        for group_id in states
+        if group_id not in changed
+    }
+    if changed:
+        group_id = changed[0]
+        group_trophies = await psn_client.async_get_earned_trophies_by_group(communication_id, group_id)
+        groups[group_id] = TrophyGroup(states[group_id], CompactTrophies.from_rows(group_trophies.get(group_id, [])))
+    return GameTrophies(groups)
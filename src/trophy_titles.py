@@ -0,0 +1,136 @@
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from parsers import CommunicationId, TrophyTitle, UnixTimestamp
+from persistent_cache import StoreNamespace
+
+if TYPE_CHECKING:
+    from psn_client import PSNClient
+
+
+class TrophyTitleIndex:
+    def __init__(self, psn_client: "PSNClient"):
+        self._psn_client = psn_client
+        self._titles: Dict[CommunicationId, TrophyTitle] = {}
+        self._watermark: Optional[UnixTimestamp] = None
+        self._backend: Optional[StoreNamespace] = None
+        self._sync_task: Optional[asyncio.Future] = None
+        # a failed sync leaves the index incomplete, get() raises this until the next sync starts
+        self._sync_error: Optional[BaseException] = None
+        # titles received by the running sync, and callers waiting for a title it has not reached yet
+        self._seen: Dict[CommunicationId, TrophyTitle] = {}
+        self._waiters: Dict[CommunicationId, List[asyncio.Future]] = {}
+        self._loaded = True
+
+    @property
+    def watermark(self) -> Optional[UnixTimestamp]:
+        return self._watermark
+
+    @property
+    def titles(self) -> Dict[CommunicationId, TrophyTitle]:
+        return self._titles
+
+    def attach(self, backend: Optional[StoreNamespace]):
+        self._backend = backend
+        self._titles = {}
+        self._watermark = None
+        self._loaded = False
+
+    def _load(self):
+        self._loaded = True
+        if self._backend is None:
+            return
+        # the record timestamp is the title's last update time, no values are read back
+        for comm_id, last_update_time in self._backend.timestamps().items():
+            self._titles[comm_id] = TrophyTitle(comm_id, last_update_time)
+        if self._titles:
+            self._watermark = max(title.last_update_time for title in self._titles.values())
+
+    def start_sync(self, full: bool = False) -> asyncio.Future:
+        if not self._loaded:
+            self._load()
+        if self._sync_task is None or self._sync_task.done():
+            self._seen = {}
+            self._sync_error = None
+            self._sync_task = asyncio.ensure_future(self._sync(full or self._watermark is None))
+            self._sync_task.add_done_callback(self._release_waiters)
+        return self._sync_task
+
+    async def sync(self, full: bool = False) -> Dict[CommunicationId, TrophyTitle]:
+        await asyncio.shield(self.start_sync(full))
+        return self._titles
+
+    async def get(self, comm_id: CommunicationId) -> Optional[TrophyTitle]:
+        # while a sync runs a title is returned as soon as it is received, or once the sync is done
+        if not self._loaded:
+            self._load()
+        if self._sync_task is None or self._sync_task.done():
+            if self._sync_error is not None:
+                title = self._seen.get(comm_id)
+                if title is None:
+                    raise self._sync_error
+                return title
+            return self._titles.get(comm_id)
+        title = self._seen.get(comm_id)
+        if title is not None:
+            return title
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(comm_id, []).append(future)
+        return await future
+
+    def _see(self, title: TrophyTitle):
+        self._seen[title.communication_id] = title
+        for future in self._waiters.pop(title.communication_id, []):
+            if not future.done():
+                future.set_result(title)
+
+    def _release_waiters(self, task: asyncio.Future):
+        if not task.cancelled():
+            self._sync_error = task.exception()
+        waiters, self._waiters = self._waiters, {}
+        for comm_id, futures in waiters.items():
+            for future in futures:
+                if future.done():
+                    continue
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(self._titles.get(comm_id))
+
+    async def _sync(self, full: bool):
+        if full:
+            titles = []
+            async for title in self._psn_client.iter_trophy_titles():
+                self._see(title)
+                titles.append(title)
+            self._titles = {}
+            self._merge(titles)
+            return
+
+        # trophyTitles come most recently updated first, everything past the watermark is already known
+        updated = []
+        titles = self._psn_client.iter_trophy_titles(prefetch=0)
+        try:
+            async for title in titles:
+                if title.last_update_time < self._watermark:
+                    break
+                self._see(title)
+                updated.append(title)
+        finally:
+            await titles.aclose()
+        logging.debug("%d trophy titles updated since %s", len(updated), self._watermark)
+        self._merge(updated)
+
+    def _merge(self, titles):
+        for title in titles:
+            known = self._titles.get(title.communication_id)
+            if known is not None and known.last_update_time == title.last_update_time:
+                continue
+            self._titles[title.communication_id] = title
+            if self._backend is not None:
+                self._backend.put(title.communication_id, None, title.last_update_time)
+        if self._titles:
+            self._watermark = max(title.last_update_time for title in self._titles.values())
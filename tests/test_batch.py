@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+from batch import FairScheduler
+
+
+@pytest.mark.asyncio
+async def test_fair_scheduler_round_robin():
+    scheduler = FairScheduler(concurrency=1)
+    order = []
+
+    async def request(owner, number):
+        async with scheduler.slot(owner):
+            order.append((owner, number))
+            await asyncio.sleep(0)
+
+    await scheduler.acquire("blocker")
+    requests = [asyncio.ensure_future(request("a", number)) for number in range(3)]
+    requests.append(asyncio.ensure_future(request("b", 0)))
+    await asyncio.sleep(0)
+    scheduler.release()
+    await asyncio.wait_for(asyncio.gather(*requests), 1)
+    assert order == [("a", 0), ("b", 0), ("a", 1), ("a", 2)]
+    assert scheduler.active == 0
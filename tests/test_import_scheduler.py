@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from import_scheduler import ImportScheduler
+
+
+@pytest.mark.asyncio
+async def test_priority_order():
+    processed = []
+
+    async def process(job):
+        processed.append(job)
+
+    scheduler = ImportScheduler(process, concurrency=1)
+    first = asyncio.ensure_future(scheduler.run([(3, "c"), (1, "a")]))
+    second = asyncio.ensure_future(scheduler.run([(2, "b")]))
+    assert await asyncio.wait_for(asyncio.gather(first, second), 1) == [[], []]
+    assert processed == ["a", "b", "c"]
+
+
+@pytest.mark.asyncio
+async def test_run_while_finished_worker_is_not_discarded_yet():
+    processed = asyncio.Event()
+
+    async def process(job):
+        if job == "first":
+            processed.set()
+
+    scheduler = ImportScheduler(process, concurrency=1, gather_window=0)
+
+    async def run_after_first():
+        await processed.wait()
+        # the worker has returned, but its done callback has not run yet
+        return await scheduler.run([(0, "second")])
+
+    results = await asyncio.wait_for(asyncio.gather(scheduler.run([(0, "first")]), run_after_first()), 1)
+    assert results == [[], []]
+    assert scheduler.queued == 0
+
+
+@pytest.mark.asyncio
+async def test_cancel_reports_queued_jobs():
+    started = asyncio.Event()
+
+    async def process(job):
+        started.set()
+        await asyncio.sleep(10)
+
+    scheduler = ImportScheduler(process, concurrency=1, gather_window=0)
+    run = asyncio.ensure_future(scheduler.run([(0, "a"), (1, "b")]))
+    await started.wait()
+    scheduler.cancel()
+    assert await asyncio.wait_for(run, 1) == ["a", "b"]
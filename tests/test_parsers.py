@@ -0,0 +1,28 @@
+import pytest
+
+from parsers import fast_parse_timestamp, parse_timestamp
+
+
+@pytest.mark.parametrize("value", [
+    "2019-01-05T01:02:03Z",
+    "1970-01-01T00:00:00Z",
+    "2020-02-29T23:59:59Z",
+])
+def test_fast_parse_timestamp(value):
+    assert fast_parse_timestamp(value) == parse_timestamp(value)
+
+
+@pytest.mark.parametrize("value", [
+    "2019-1-05T01:02:03Z",
+    "2019-01-5T01:02:03Z",
+])
+def test_fast_parse_timestamp_fallback_is_integer(value):
+    timestamp = fast_parse_timestamp(value)
+    assert isinstance(timestamp, int)
+    assert timestamp == parse_timestamp(value)
+
+
+@pytest.mark.parametrize("value", ["2019-02-30T01:02:03Z", "2019-01-05T24:02:03Z", "2019-01-05 01:02:03"])
+def test_fast_parse_timestamp_invalid(value):
+    with pytest.raises(ValueError):
+        fast_parse_timestamp(value)
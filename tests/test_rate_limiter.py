@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from rate_limiter import HostLimiter, HostPolicy, TokenBucket, parse_retry_after
+
+SINGLE_SLOT = HostPolicy(rate=1000, max_rate=1000, burst=1000, initial_concurrency=1, max_concurrency=1)
+
+
+@pytest.mark.asyncio
+async def test_released_slot_goes_to_oldest_waiter():
+    limiter = HostLimiter("host", SINGLE_SLOT)
+    order = []
+
+    async def request(name):
+        await limiter.acquire()
+        order.append(name)
+        await asyncio.sleep(0)
+        limiter.on_success()
+        limiter.release()
+
+    await limiter.acquire()
+    waiting = [asyncio.ensure_future(request(name)) for name in ("first", "second")]
+    await asyncio.sleep(0)
+    limiter.release()
+    # arrives after the slot was freed, but before the waiter handed the slot had a chance to run
+    await request("late")
+    await asyncio.wait_for(asyncio.gather(*waiting), 1)
+    assert order == ["first", "second", "late"]
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_passes_slot_on():
+    limiter = HostLimiter("host", SINGLE_SLOT)
+    await limiter.acquire()
+    cancelled = asyncio.ensure_future(limiter.acquire())
+    other = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    limiter.release()
+    cancelled.cancel()
+    await asyncio.wait_for(other, 1)
+    assert limiter.in_flight == 1
+    assert limiter.queue_depth == 0
+
+
+def test_throttling_halves_rate():
+    limiter = HostLimiter("host", HostPolicy(rate=40, min_rate=1))
+    limiter.on_throttled(0)
+    assert limiter.stats()["rate"] == 20
+    limiter.on_success()
+    assert limiter.stats()["rate"] == 20.5
+
+
+def test_token_bucket_waits_once_burst_is_used():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None